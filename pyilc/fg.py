@@ -364,7 +364,10 @@ def get_mix_bandpassed(bp_list, comp, param_dict_file=None,bandpass_shifts=None,
 
 
     if (comp == 'CIB' or comp == 'rSZ' or comp == 'radio'):
-        if param_dict_file is None:
+        if param_dict_override is not None:
+            assert param_dict_file is None
+            p = param_dict_override
+        elif param_dict_file is None:
             p = default_dict
         else:
             p = read_param_dict_from_yaml(param_dict_file)
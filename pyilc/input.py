@@ -113,6 +113,14 @@ class ILCInfo(object):
             self.taper_width = p['taper_width']
         assert self.ELLMAX - self.taper_width > 10., "desired taper is too broad for given ELLMAX"
 
+        # number of Jacobi iterations in the spherical harmonic analysis (map2alm) of the input and wavelet coefficient maps.
+        # Defaults to 3 (the healpy default). 0 (a single analysis pass) is ~4x faster, but is only accurate if the maps
+        # have little power above ell ~ N_side
+        self.analysis_iter = 3
+        if 'analysis_iter' in p.keys():
+            self.analysis_iter = p['analysis_iter']
+        assert type(self.analysis_iter) is int and self.analysis_iter >= 0, "analysis_iter"
+
         if not self.wavelet_type == 'TopHatHarmonic':
             # Number of scales for the NILC
             self.N_scales = p['N_scales']
@@ -157,6 +165,20 @@ class ILCInfo(object):
             #self.J_min = p['J_min']
 
         
+        # number of threads used in the spherical harmonic transforms (only if ducc0 is installed)
+        # defaults to all available cores
+        self.N_threads = os.cpu_count()
+        if 'N_threads' in p.keys():
+            self.N_threads = p['N_threads']
+        assert type(self.N_threads) is int and self.N_threads > 0, "N_threads"
+
+        # number of frequency maps to waveletize concurrently; the N_threads threads are shared between these jobs
+        # memory usage grows with the number of concurrent jobs, so this defaults to 1
+        self.N_waveletize_jobs = 1
+        if 'N_waveletize_jobs' in p.keys():
+            self.N_waveletize_jobs = p['N_waveletize_jobs']
+        assert type(self.N_waveletize_jobs) is int and self.N_waveletize_jobs > 0, "N_waveletize_jobs"
+
         # flag to perform cross-ILC 
         self.cross_ILC = False
         if 'cross_ILC' in p.keys():
@@ -218,12 +240,43 @@ class ILCInfo(object):
             if p['wavelet_maps_exist'].lower() in ['true','yes','y']:
                 self.wavelet_maps_exist = True
 
+        # keep the wavelet coefficient maps in memory once they are computed (or read in), rather than reading them back in
+        # from the saved files at the covariance and ILC map steps. This avoids the repeated FITS I/O, but requires enough
+        # memory to hold all of the wavelet coefficient maps at once. Defaults to False
+        self.keep_wavelet_maps_in_memory = False
+        if 'keep_wavelet_maps_in_memory' in p.keys():
+            if p['keep_wavelet_maps_in_memory'].lower() in ['true','yes','y']:
+                self.keep_wavelet_maps_in_memory = True
+        self.wavelet_maps_in_memory = {}
+
+        # store the needlet coefficient maps in single precision (on disk and in memory), which halves their size
+        # N.B. the per-pixel covariance matrices can be poorly conditioned, so this can change the inverse covariance
+        # (and hence the ILC weights) at the ~1e-3 relative level. Defaults to False
+        self.single_precision_wavelet_maps = False
+        if 'single_precision_wavelet_maps' in p.keys():
+            if p['single_precision_wavelet_maps'].lower() in ['true','yes','y']:
+                self.single_precision_wavelet_maps = True
+
         # do the covariance maps already exist as saved files? we can tell the code to skip the check for this, if 
         # we know this alredy. Deafults to False
         self.inv_covmat_exists= False
         if 'inv_covmat_exists' in p.keys():
             if p['inv_covmat_exists'].lower() in ['true','yes','y']:
                 self.inv_covmat_exists= True
+
+        # the inversion of the covariance matrices is checked (C^-1 C = 1) on a random subset of (at most 1024) pixels at each scale;
+        # set this to True to check every pixel instead, which is as expensive as the inversion itself. Defaults to False
+        self.check_inv_covmat_all_pixels = False
+        if 'check_inv_covmat_all_pixels' in p.keys():
+            if p['check_inv_covmat_all_pixels'].lower() in ['true','yes','y']:
+                self.check_inv_covmat_all_pixels = True
+
+        # save the NILC weights of all frequencies at each scale in one .npy file, and read them back in instead of recomputing them
+        # if the code is rerun with the same settings. Defaults to False
+        self.cache_weights = False
+        if 'cache_weights' in p.keys():
+            if p['cache_weights'].lower() in ['true','yes','y']:
+                self.cache_weights = True
  
         # frequency map file names
         self.freq_map_files = p['freq_map_files']
@@ -33,7 +33,7 @@ info.read_beams()
 
 ##########################
 # construct wavelets
-wv = Wavelets(N_scales=info.N_scales, ELLMAX=info.ELLMAX, tol=1.e-6, taper_width=info.taper_width)
+wv = Wavelets(N_scales=info.N_scales, ELLMAX=info.ELLMAX, tol=1.e-6, taper_width=info.taper_width, analysis_iter=info.analysis_iter)
 if info.wavelet_type == 'GaussianNeedlets':
     ell, filts = wv.GaussianNeedlets(FWHM_arcmin=info.GN_FWHM_arcmin)
 elif info.wavelet_type == 'CosineNeedlets': # Fiona added CosineNeedlets
@@ -3,6 +3,13 @@ import numpy as np
 import healpy as hp
 from astropy.io import fits
 import os
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import threading
+try:
+    import ducc0
+except ImportError:
+    ducc0 = None
 import matplotlib
 matplotlib.use('pdf')
 matplotlib.rc('font', family='serif', serif='cm10')
@@ -11,7 +18,7 @@ fontProperties = {'family':'sans-serif',
                   'weight' : 'normal', 'size' : 16}
 import matplotlib.pyplot as plt
 from input import ILCInfo
-from fg import get_mix, get_mix_bandpassed
+from fg import get_mix, get_mix_bandpassed, read_param_dict_from_yaml
 """
 this module constructs the Wavelets class, which contains the
 harmonic-space filters defining a set of wavelets, as well as
@@ -32,24 +39,51 @@ the module also contains wavelet transformation functions
 the module also contains the wavelet ILC function
 """
 
+# raised when the ILC weights at a scale do not have the required response to the preserved and deprojected components
+class ResponseCheckError(RuntimeError):
+    pass
+
+# Gaussian needlet filters in harmonic space, used by Wavelets.GaussianNeedlets
+# these only depend on the arguments, so they are cached for repeated calls (the returned array is read-only)
+@functools.lru_cache(maxsize=8)
+def _gaussian_needlet_filters(FWHM_arcmin, ELLMAX, N_scales):
+    ell = np.arange(ELLMAX+1)
+    sigma = np.asarray(FWHM_arcmin) * np.pi/(180.*60.) / np.sqrt(8.*np.log(2.))
+    # define gaussians (same as hp.gauss_beam, for all FWHM values at once)
+    Gaussians = np.exp(-0.5 * ell*(ell+1.) * (sigma**2.)[:,None])
+    # define needlet filters in harmonic space
+    filters = np.ones((N_scales,ELLMAX+1),dtype=float)
+    filters[0] = Gaussians[0]
+    filters[1:N_scales-1] = np.sqrt(np.maximum(Gaussians[1:]**2. - Gaussians[:-1]**2., 0.))
+    filters[N_scales-1] = np.sqrt(1. - Gaussians[N_scales-2]**2.)
+    filters.flags.writeable = False
+    return filters
+
 class Wavelets(object):
     # initialize the filters to unity
     # construct non-trivial filters (or user can define)
-    def __init__(self, N_scales=10, ELLMAX=4097, tol=1.e-6, taper_width=200):
+    def __init__(self, N_scales=10, ELLMAX=4097, tol=1.e-6, taper_width=200, analysis_iter=3):
         self.N_scales = N_scales #number of needlet filters
         self.ELLMAX = ELLMAX #maximum multipole
         self.tol = tol #tolerance for transmission condition
         # Include option to apply a taper near ELLMAX to avoid aliasing of small-scale power 
         # due to sharp truncation. Set taper_width to zero for no taper
         self.taper_width = taper_width 
+        # number of Jacobi iterations used in map2alm when waveletizing and synthesizing maps (3 is the healpy default)
+        # analysis_iter=0 does a single analysis pass, which is ~4x faster but only accurate for ELLMAX well below N_side
+        self.analysis_iter = analysis_iter
         assert(self.N_scales > 0)
         assert(type(self.N_scales) is int)
         assert(self.ELLMAX > 0)
         assert(type(self.ELLMAX) is int)
         # initialize filters
-        self.ell = np.linspace(0, self.ELLMAX, num=ELLMAX+1, endpoint=True, retstep=False)
         self.filters = np.ones((self.N_scales,self.ELLMAX+1),dtype=float)
 
+    # multipoles at which the filters are defined
+    @property
+    def ell(self):
+        return np.arange(self.ELLMAX+1)
+
     # Planck 2015 NILC y-map Gaussian needlet filters: [600', 300', 120', 60', 30', 15', 10', 7.5', 5']
     # Planck 2016 GNILC Gaussian needlet filters: [300' , 120' , 60' , 45' , 30' , 15' , 10' , 7.5' , 5']
     # (Thanks to Mathieu Remazeilles for providing these numbers (2/22/19) -- although the y-map filters are still slightly different at low ell than those in the paper)
@@ -63,16 +97,7 @@ class Wavelets(object):
             raise AssertionError
         # check consistency with N_scales
         assert(len(FWHM_arcmin) == self.N_scales - 1)
-        FWHM = FWHM_arcmin * np.pi/(180.*60.)
-        # define gaussians
-        Gaussians = np.zeros((self.N_scales-1,self.ELLMAX+1))
-        for i in range(self.N_scales-1):
-            Gaussians[i] = hp.gauss_beam(FWHM[i], lmax=self.ELLMAX)
-        # define needlet filters in harmonic space
-        self.filters[0] = Gaussians[0]
-        for i in range(1,self.N_scales-1):
-            self.filters[i] = np.sqrt(Gaussians[i]**2. - Gaussians[i-1]**2.)
-        self.filters[self.N_scales-1] = np.sqrt(1. - Gaussians[self.N_scales-2]**2.)
+        self.filters = np.array(_gaussian_needlet_filters(tuple(FWHM_arcmin), self.ELLMAX, self.N_scales))
         # simple check to ensure that sum of squared transmission is unity as needed for NILC algorithm
         assert (np.absolute( np.sum( self.filters**2., axis=0 ) - np.ones(self.ELLMAX+1,dtype=float)) < self.tol).all(), "wavelet filter transmission check failed"
         return self.ell, self.filters
@@ -110,7 +135,6 @@ class Wavelets(object):
 
         # simple check to ensure that sum of squared transmission is unity as needed for NILC algorithm 
         assert (np.absolute( np.sum( self.filters**2., axis=0 ) - np.ones(self.ELLMAX+1,dtype=float)) < self.tol).all(), "wavelet filter transmission check failed"
-        self.ell = ells
         return self.ell, self.filters
 
     # scale-discretized wavelets
@@ -146,36 +170,83 @@ class Wavelets(object):
         plt.grid(alpha=0.5)
         plt.savefig(filename+log_or_lin+'.pdf')
 
+    # returns a function waveletizer(inp_map, alm_buf=None) that applies the wavelet transform (i.e., filters) to a map, as waveletize does
+    # everything that does not depend on the map (the combined filter, taper and rebeaming factors, the scales to output and
+    # their N_side values) is set up here once, so the returned function can be applied to many maps with the same settings
+    def compile_waveletizer(self, rebeam=False, inp_beam=None, new_beam=None, wv_filts_to_use=None, N_side_to_use=None, nthreads=None):
+        if(rebeam):
+            assert inp_beam is not None, "no input beam defined"
+            assert new_beam is not None, "no new beam defined"
+            assert len(inp_beam) == len(new_beam), "input and new beams have different ell_max"
+            assert inp_beam[0][0] == 0 and new_beam[0][0] == 0, "beam profiles must start at ell=0"
+            assert inp_beam[-1][0] == self.ELLMAX and new_beam[-1][0] == self.ELLMAX, "beam profiles must end at ELLMAX"
+            beam_fac = new_beam[:,1]/inp_beam[:,1]
+        else:
+            beam_fac = np.ones(self.ELLMAX+1,dtype=float)
+        if(self.taper_width):
+            assert self.ELLMAX - self.taper_width > 10., "desired taper is too broad for given ELLMAX"
+            taper_func = (1.0 - 0.5*(np.tanh(0.025*(self.ell - (self.ELLMAX - self.taper_width))) + 1.0)) #smooth taper to zero from ELLMAX-taper_width to ELLMAX
+        else:
+            taper_func = np.ones(self.ELLMAX+1,dtype=float)
+        # fold the taper and rebeaming factors into the wavelet filters once, rather than at every scale
+        filts = self.filters * (taper_func*beam_fac)
+        if wv_filts_to_use is not None: #allow user to only output maps for some of the filter scales
+            assert len(wv_filts_to_use) == self.N_scales, "wv_filts_to_use has wrong shape"
+            scales = [j for j in range(self.N_scales) if wv_filts_to_use[j] == True]
+        else:
+            scales = list(range(self.N_scales))
+        if N_side_to_use is not None:
+            assert len(N_side_to_use) == self.N_scales, "N_side_to_use has wrong shape"
+        l_of_alm = _l_of_alm(self.ELLMAX)
+
+        def waveletizer(inp_map, alm_buf=None):
+            N_side_inp = hp.npix2nside(len(inp_map))
+            assert self.ELLMAX < 3*N_side_inp-1, "ELLMAX too high"
+            if N_side_to_use is None:
+                N_side_out = np.ones(self.N_scales, dtype=int)*N_side_inp
+            else:
+                N_side_out = N_side_to_use
+                assert (np.asarray(N_side_out) <= N_side_inp).all(), "N_side_to_use > N_side_inp"
+            # convert map to alm, apply wavelet filters (and taper and rebeam)
+            # the filtered alm for each scale is written into a single reusable buffer
+            inp_map_alm = _map2alm(inp_map, lmax=self.ELLMAX, iter=self.analysis_iter, nthreads=nthreads)
+            if alm_buf is None:
+                alm_buf = np.empty_like(inp_map_alm)
+            assert alm_buf.shape == inp_map_alm.shape and alm_buf.dtype == np.complex128, "alm_buf has wrong shape or dtype"
+            wv_maps = []
+            for j in scales:
+                np.multiply(inp_map_alm, filts[j][l_of_alm], out=alm_buf)
+                wv_maps.append( _alm2map( alm_buf, N_side_out[j], nthreads=nthreads) )
+            # return maps of wavelet coefficients (i.e., filtered maps) -- N.B. each one can have a different N_side
+            return wv_maps
+        return waveletizer
+
+# criterion to determine which frequency maps to use for each wavelet filter scale
+# require multipole ell_F where wavelet filter F(ell_F) = wavelet_beam_criterion (on its decreasing side)
+#   to be less than the multipole ell_B where the beam B(ell_B) = wavelet_beam_criterion
+# note that this assumes monotonicity of the beam
+# and assumes filter function has a decreasing side, which is generally not true for the smallest-scale wavelet filter
+# also returns the N_side value to use for each filter scale: the smallest power of two larger than ell_F, capped at info.N_side
+def _freqs_and_N_side_to_use(wv, info):
+    crit = info.wavelet_beam_criterion
+    ell = np.arange(wv.ELLMAX+1)
+    ell_peak = np.argmax(wv.filters[:-1], axis=1) #we'll use this to ensure we're on the decreasing side of the filter
+    ell_F = np.argmin(np.where(ell >= ell_peak[:,None], np.abs(wv.filters[:-1] - crit), np.inf), axis=1)
+    ell_F = np.append(ell_F, ell_F[-1]) #just use the second-to-last criterion for the last one #TODO: improve this
+    ell_B = np.argmin(np.abs(np.asarray(info.beams)[:,:,1] - crit), axis=1)
+    freqs_to_use = ell_F[:,None] <= ell_B[None,:]
+    N_side_to_use = np.minimum(2**np.ceil(np.log2(ell_F+1)).astype(int), info.N_side)
+    return freqs_to_use, N_side_to_use
+
 class scale_info(object):
     ## It might be better to let this inherit from the wavelets class, and just use one scale_info object instead of both wavelets
     ## and scale_info - possibly a future edit
     def __init__(self,wv,info,):
         ##########################
-        # criterion to determine which frequency maps to use for each wavelet filter scale
-        # require multipole ell_F where wavelet filter F(ell_F) = wavelet_beam_criterion (on its decreasing side)
-        #   to be less than the multipole ell_B where the beam B(ell_B) = wavelet_beam_criterion
-        # note that this assumes monotonicity of the beam
-        # and assumes filter function has a decreasing side, which is generally not true for the smallest-scale wavelet filter
-        self.freqs_to_use = np.full((wv.N_scales,info.N_freqs), False)
-        self.N_freqs_to_use = np.zeros(wv.N_scales,dtype=int)
-        self.N_side_to_use = np.ones(wv.N_scales,dtype=int)*info.N_side #initialize all of the internal, per-scale N_side values to the output N_side
-        ell_F = np.zeros(wv.N_scales)
-        ell_B = np.zeros(info.N_freqs)
-        for i in range(wv.N_scales-1):
-            ell_peak = np.argmax(wv.filters[i]) #we'll use this to ensure we're on the decreasing side of the filter
-            ell_F[i] = ell_peak + (np.abs( wv.filters[i][ell_peak:] - info.wavelet_beam_criterion )).argmin()
-            if ell_F[i] > wv.ELLMAX:
-                ell_F[i] = wv.ELLMAX
-        ell_F[-1] = ell_F[-2] #just use the second-to-last criterion for the last one #TODO: improve this
-        for j in range(info.N_freqs):
-            ell_B[j] = (np.abs( (info.beams[j])[:,1] - info.wavelet_beam_criterion )).argmin()
+        # determine which frequency maps to use, and the N_side value to use, for each wavelet filter scale
+        self.freqs_to_use, self.N_side_to_use = _freqs_and_N_side_to_use(wv, info)
+        self.N_freqs_to_use = np.sum(self.freqs_to_use, axis=1)
         for i in range(wv.N_scales):
-            for j in range(info.N_freqs):
-                if ell_F[i] <= ell_B[j]:
-                    self.freqs_to_use[i][j] = True
-                    self.N_freqs_to_use[i] += 1
-                else:
-                    self.freqs_to_use[i][j] = False
             # Fiona override Nfreqstouse
             if info.override_N_freqs_to_use:
                 self.N_freqs_to_use[i] = info.N_freqs_to_use[i]
@@ -191,19 +262,11 @@ class scale_info(object):
                 assert((info.N_deproj + 1) <= self.N_freqs_to_use[i]), "not enough frequency channels to deproject this many components at scale "+str(i)
             else:
                 assert((info.N_deproj[i] + 1) <= self.N_freqs_to_use[i]), "not enough frequency channels to deproject this many components at scale "+ str()
-            # determine N_side value to use for each filter scale, by finding the smallest valid N_side larger than ell_F[i]
-            for j in range(20):
-                if (ell_F[i] < 2**j):
-                    self.N_side_to_use[i] = int(2**j)
-                    break
-            if (self.N_side_to_use[i] > info.N_side):
-                self.N_side_to_use[i] = info.N_side
         self.N_pix_to_use = 12*(self.N_side_to_use)**2
         ##########################
         ##########################
         # criterion to determine the real-space gaussian FWHM used in wavelet ILC
         # based on ILC bias mode-counting
-        self.FWHM_pix = np.zeros(wv.N_scales,dtype=float)
         if info.wavelet_type == 'GaussianNeedlets':
             ell, filts = wv.GaussianNeedlets(info.GN_FWHM_arcmin)
         elif info.wavelet_type == 'TopHatHarmonic':
@@ -216,69 +279,120 @@ class scale_info(object):
             raise NotImplementedError
         # compute effective number of modes associated with each filter (on the full sky)
         # note that the weights we use are filt^2, since this is the quantity that sums to unity at each ell
-        N_modes = np.zeros(wv.N_scales, dtype=float)
-        for i in range(wv.N_scales):
-            N_modes[i] = np.sum( (2.*ell + np.ones(wv.ELLMAX+1)) * (filts[i])**2. )
+        N_modes = np.sum( (2.*ell + 1.) * filts**2., axis=1 )
         # now find real-space Gaussian s.t. number of modes in that area satisfies ILC bias threshold
         # we use the flat-sky approximation here -- TODO: could improve this
-        for i in range(wv.N_scales):
-            # this expression comes from noting that ILC_bias_tol = (N_deproj+1 - N_freqs)/N_modes_eff
-            #   where N_modes_eff = N_modes * (2*pi*sigma_pix^2)/(4*pi)
-            #   and then solving for sigma_pix
-            # note that this corrects an error in Eq. 3 of Planck 2015 y-map paper -- the numerator should be (N_ch - 2) in their case (if they're deprojecting CMB)
-            if type(info.N_deproj) is int:
-                sigma_pix_temp = np.sqrt( np.absolute( 2.*(float( (info.N_deproj + 1) - self.N_freqs_to_use[i] )) / (N_modes[i] * info.ILC_bias_tol) ) ) #result is in radians
-            else:
-                sigma_pix_temp = np.sqrt( np.absolute( 2.*(float( (info.N_deproj[i] + 1) - self.N_freqs_to_use[i] )) / (N_modes[i] * info.ILC_bias_tol) ) ) #result is in radians
-            assert sigma_pix_temp < np.pi, "not enough modes to satisfy ILC_bias_tol" #don't want real-space gaussian to be the full sky or close to it
-            # note that sigma_pix_temp can come out zero if N_deproj+1 = N_freqs_to_use (formally bias vanishes in this case because the problem is fully constrained)
-            # for now, just set equal to case where N_freqs_to_use = N_deproj
-            if sigma_pix_temp == 0.:
-                sigma_pix_temp = np.sqrt( np.absolute( 2. / (N_modes[i] * info.ILC_bias_tol) ) ) #result is in radians
-            self.FWHM_pix[i] = np.sqrt(8.*np.log(2.)) * sigma_pix_temp #in radians
+        # this expression comes from noting that ILC_bias_tol = (N_deproj+1 - N_freqs)/N_modes_eff
+        #   where N_modes_eff = N_modes * (2*pi*sigma_pix^2)/(4*pi)
+        #   and then solving for sigma_pix
+        # note that this corrects an error in Eq. 3 of Planck 2015 y-map paper -- the numerator should be (N_ch - 2) in their case (if they're deprojecting CMB)
+        N_deproj = np.broadcast_to(info.N_deproj, (wv.N_scales,))
+        sigma_pix = np.sqrt( np.absolute( 2.*( (N_deproj + 1) - self.N_freqs_to_use ).astype(float) / (N_modes * info.ILC_bias_tol) ) ) #result is in radians
+        assert (sigma_pix < np.pi).all(), "not enough modes to satisfy ILC_bias_tol" #don't want real-space gaussian to be the full sky or close to it
+        # note that sigma_pix can come out zero if N_deproj+1 = N_freqs_to_use (formally bias vanishes in this case because the problem is fully constrained)
+        # for now, just set equal to case where N_freqs_to_use = N_deproj
+        sigma_pix = np.where(sigma_pix == 0., np.sqrt( np.absolute( 2. / (N_modes * info.ILC_bias_tol) ) ), sigma_pix) #result is in radians
+        self.FWHM_pix = np.sqrt(8.*np.log(2.)) * sigma_pix #in radians
         print("fwhms are",self.FWHM_pix)
 
+##########################
+# spherical harmonic transforms
+# if ducc0 is installed we use its multi-threaded SHTs, otherwise we fall back to healpy
+# both use RING-ordered maps and the healpy alm ordering, so the two are interchangeable
+@functools.lru_cache(maxsize=None)
+def _healpix_geom(N_side):
+    return ducc0.healpix.Healpix_Base(N_side, "RING").sht_info()
+
+# multipole ell of each entry of a healpy-ordered alm array with the given lmax; indexing a filter f_ell with this
+# expands it to the alm layout, so that filtering is a single multiply rather than a call to hp.almxfl
+@functools.lru_cache(maxsize=None)
+def _l_of_alm(lmax):
+    l_of_alm = hp.Alm.getlm(lmax)[0].astype(np.int32)
+    l_of_alm.setflags(write=False)
+    return l_of_alm
+
+def _map2alm(inp_map, lmax, iter=3, nthreads=None):
+    # inp_map can be a single map or a stack of maps with shape (N_maps, N_pix); a stack is transformed in one batched call
+    if ducc0 is None:
+        if np.ndim(inp_map) == 2:
+            return np.array([hp.map2alm(m, lmax=lmax, iter=iter) for m in inp_map])
+        return hp.map2alm(inp_map, lmax=lmax, iter=iter)
+    if nthreads is None:
+        nthreads = os.cpu_count()
+    out_shape = np.shape(inp_map)[:-1]
+    inp_map = np.asarray(inp_map, dtype=np.float64).reshape(-1,1,np.shape(inp_map)[-1])
+    geom = _healpix_geom(hp.npix2nside(inp_map.shape[-1]))
+    pix_area = 4.*np.pi/inp_map.shape[-1]
+    alm = ducc0.sht.adjoint_synthesis(map=inp_map, lmax=lmax, spin=0, nthreads=nthreads, **geom)
+    alm *= pix_area
+    # same Jacobi iteration scheme as healpy's map2alm; the residual map and its alms are written into buffers reused at each iteration
+    if iter > 0:
+        resid = np.empty_like(inp_map)
+        alm_resid = np.empty_like(alm)
+    for i in range(iter):
+        ducc0.sht.synthesis(alm=alm, lmax=lmax, spin=0, nthreads=nthreads, map=resid, **geom)
+        np.subtract(inp_map, resid, out=resid)
+        ducc0.sht.adjoint_synthesis(map=resid, lmax=lmax, spin=0, nthreads=nthreads, alm=alm_resid, **geom)
+        alm_resid *= pix_area
+        alm += alm_resid
+    return alm.reshape(out_shape+(alm.shape[-1],))
+
+def _alm2map(alm, N_side, nthreads=None, out=None):
+    # alm can be a single set of alms or a stack with shape (N_maps, N_alm); a stack is transformed in one batched call
+    # if out (a contiguous float64 array of the output shape) is given, the map(s) are written into it
+    if ducc0 is None:
+        if np.ndim(alm) == 2:
+            out_map = np.array([hp.alm2map(a, nside=N_side) for a in alm])
+        else:
+            out_map = hp.alm2map(alm, nside=N_side)
+        if out is not None:
+            np.copyto(out, out_map)
+            return out
+        return out_map
+    if nthreads is None:
+        nthreads = os.cpu_count()
+    out_shape = np.shape(alm)[:-1]
+    lmax = hp.Alm.getlmax(np.shape(alm)[-1])
+    alm = np.asarray(alm, dtype=np.complex128).reshape(-1,1,np.shape(alm)[-1])
+    if out is not None:
+        ducc0.sht.synthesis(alm=alm, lmax=lmax, spin=0, nthreads=nthreads, map=out.reshape(-1,1,out.shape[-1]), **_healpix_geom(int(N_side)))
+        return out
+    out_map = ducc0.sht.synthesis(alm=alm, lmax=lmax, spin=0, nthreads=nthreads, **_healpix_geom(int(N_side)))
+    return out_map.reshape(out_shape+(out_map.shape[-1],))
+
+# identity matrix used to check the cov matrix inversions, cached since the same N_freqs recurs at every scale
+@functools.lru_cache(maxsize=None)
+def _eye(N):
+    eye = np.eye(N)
+    eye.setflags(write=False)
+    return eye
+
+# Gaussian beam expanded to the alm layout, cached since the same FWHM is used for every smoothing at a given scale
+@functools.lru_cache(maxsize=16)
+def _gauss_beam_alm(FWHM, lmax):
+    gauss_bl_alm = hp.gauss_beam(FWHM, lmax=lmax)[_l_of_alm(lmax)]
+    gauss_bl_alm.setflags(write=False)
+    return gauss_bl_alm
+
+# Gaussian smoothing of a map (or a stack of maps with shape (N_maps, N_pix)), equivalent to hp.sphtfunc.smoothing (with the same iter)
+# the alms are filtered in place and transformed straight back, so no other alm-sized arrays are allocated
+# if out (a contiguous float64 array with the shape of maps) is given, the smoothed maps are written into it
+def _smooth_maps(maps, FWHM, iter=3, nthreads=None, out=None):
+    N_side = hp.npix2nside(np.shape(maps)[-1])
+    lmax = 3*N_side-1
+    alms = np.atleast_2d(_map2alm(maps, lmax=lmax, iter=iter, nthreads=nthreads))
+    alms *= _gauss_beam_alm(float(FWHM), lmax)
+    return _alm2map(alms.reshape(np.shape(maps)[:-1]+(alms.shape[-1],)), N_side, nthreads=nthreads, out=out)
+##########################
+
 # apply wavelet transform (i.e., filters) to a map
-def waveletize(inp_map=None, wv=None, rebeam=False, inp_beam=None, new_beam=None, wv_filts_to_use=None, N_side_to_use=None):
+# alm_buf can be passed in to reuse the same complex128 buffer of size hp.Alm.getsize(wv.ELLMAX) across calls
+def waveletize(inp_map=None, wv=None, rebeam=False, inp_beam=None, new_beam=None, wv_filts_to_use=None, N_side_to_use=None, nthreads=None, alm_buf=None):
     assert inp_map is not None, "no input map specified"
-    N_pix = len(inp_map)
-    N_side_inp = hp.npix2nside(N_pix)
     assert wv is not None, "wavelets not defined"
     assert type(wv) is Wavelets, "Wavelets TypeError"
-    assert wv.ELLMAX < 3*N_side_inp-1, "ELLMAX too high"
-    if (N_side_to_use is None):
-        N_side_to_use = np.ones(wv.N_scales, dtype=int)*N_side_inp
-    if(rebeam):
-        assert inp_beam is not None, "no input beam defined"
-        assert new_beam is not None, "no new beam defined"
-        assert len(inp_beam) == len(new_beam), "input and new beams have different ell_max"
-        assert inp_beam[0][0] == 0 and new_beam[0][0] == 0, "beam profiles must start at ell=0"
-        assert inp_beam[-1][0] == wv.ELLMAX and new_beam[-1][0] == wv.ELLMAX, "beam profiles must end at ELLMAX"
-        beam_fac = new_beam[:,1]/inp_beam[:,1]
-    else:
-        beam_fac = np.ones(wv.ELLMAX+1,dtype=float)
-    if(wv.taper_width):
-        assert wv.ELLMAX - wv.taper_width > 10., "desired taper is too broad for given ELLMAX"
-        taper_func = (1.0 - 0.5*(np.tanh(0.025*(wv.ell - (wv.ELLMAX - wv.taper_width))) + 1.0)) #smooth taper to zero from ELLMAX-taper_width to ELLMAX
-    else:
-        taper_func = np.ones(wv.ELLMAX+1,dtype=float)
-    # convert map to alm, apply wavelet filters (and taper and rebeam)
-    inp_map_alm = hp.map2alm(inp_map, lmax=wv.ELLMAX)
-    wv_maps = []
-    if wv_filts_to_use is not None: #allow user to only output maps for some of the filter scales
-        assert len(wv_filts_to_use) == wv.N_scales, "wv_filts_to_use has wrong shape"
-        assert len(N_side_to_use) == wv.N_scales, "N_side_to_use has wrong shape"
-        for j in range(wv.N_scales):
-            assert N_side_to_use[j] <= N_side_inp, "N_side_to_use > N_side_inp"
-            if wv_filts_to_use[j] == True:
-                wv_maps.append( hp.alm2map( hp.almxfl( inp_map_alm, (wv.filters[j])*taper_func*beam_fac), nside=N_side_to_use[j]) )
-    else:
-        assert len(N_side_to_use) == wv.N_scales, "N_side_to_use has wrong shape"
-        for j in range(wv.N_scales):
-            assert N_side_to_use[j] <= N_side_inp, "N_side_to_use > N_side_inp"
-            wv_maps.append( hp.alm2map( hp.almxfl( inp_map_alm, (wv.filters[j])*taper_func*beam_fac), nside=N_side_to_use[j]) )
-    # return maps of wavelet coefficients (i.e., filtered maps) -- N.B. each one can have a different N_side
-    return wv_maps
+    waveletizer = wv.compile_waveletizer(rebeam=rebeam, inp_beam=inp_beam, new_beam=new_beam, wv_filts_to_use=wv_filts_to_use, N_side_to_use=N_side_to_use, nthreads=nthreads)
+    return waveletizer(inp_map, alm_buf=alm_buf)
 
 # Find nth wavelet coefficients of a map
 def find_nth_wavelet_coefficient(scale,inp_map=None,inp_map_alm=None, wv=None, rebeam=False, inp_beam=None, new_beam=None, wv_filts_to_use=None, N_side_to_use=None):
@@ -307,7 +421,7 @@ def find_nth_wavelet_coefficient(scale,inp_map=None,inp_map_alm=None, wv=None, r
         taper_func = np.ones(wv.ELLMAX+1,dtype=float)
     # convert map to alm, apply wavelet filters (and taper and rebeam)
     if inp_map_alm is not None:
-        inp_map_alm = hp.map2alm(inp_map, lmax=wv.ELLMAX)
+        inp_map_alm = _map2alm(inp_map, lmax=wv.ELLMAX, iter=wv.analysis_iter)
     wv_maps = []
     if wv_filts_to_use is not None: #allow user to only output maps for some of the filter scales
         assert len(wv_filts_to_use) == wv.N_scales, "wv_filts_to_use has wrong shape"
@@ -315,12 +429,12 @@ def find_nth_wavelet_coefficient(scale,inp_map=None,inp_map_alm=None, wv=None, r
         for j in [scale]:
             assert N_side_to_use[j] <= N_side_inp, "N_side_to_use > N_side_inp"
             if wv_filts_to_use[j] == True:
-                wv_maps.append( hp.alm2map( hp.almxfl( inp_map_alm, (wv.filters[j])*taper_func*beam_fac), nside=N_side_to_use[j]) )
+                wv_maps.append( _alm2map( inp_map_alm * ((wv.filters[j])*taper_func*beam_fac)[_l_of_alm(wv.ELLMAX)], N_side_to_use[j]) )
     else:
         assert len(N_side_to_use) == wv.N_scales, "N_side_to_use has wrong shape"
         for j in [scale]:
             assert N_side_to_use[j] <= N_side_inp, "N_side_to_use > N_side_inp"
-            wv_maps.append( hp.alm2map( hp.almxfl( inp_map_alm, (wv.filters[j])*taper_func*beam_fac), nside=N_side_to_use[j]) )
+            wv_maps.append( _alm2map( inp_map_alm * ((wv.filters[j])*taper_func*beam_fac)[_l_of_alm(wv.ELLMAX)], N_side_to_use[j]) )
     # return maps of wavelet coefficients (i.e., filtered maps) -- N.B. each one can have a different N_side
     return wv_maps[0]
 
@@ -336,124 +450,254 @@ def synthesize(wv_maps=None, wv=None, N_side_out=None):
     assert wv.ELLMAX < 3*N_side_out-1, "ELLMAX too high"
     N_pix_out = 12*N_side_out**2
     out_map = np.zeros(N_pix_out)
+    map_buf = np.empty(N_pix_out) # reused for the contribution of each scale
     for j in range(wv.N_scales):
         N_pix_temp = len(wv_maps[j])
         N_side_temp = hp.npix2nside(N_pix_temp)
-        temp_alm = hp.map2alm(wv_maps[j], lmax=np.amin(np.array([wv.ELLMAX, 3*N_side_temp-1])))
-        if (3*N_side_temp-1 < wv.ELLMAX):
-            temp_alm_filt = hp.almxfl(temp_alm, (wv.filters[j])[:3*N_side_temp])
-        else:
-            temp_alm_filt = hp.almxfl(temp_alm, wv.filters[j])
-        out_map += hp.alm2map(temp_alm_filt, nside=N_side_out)
+        lmax_temp = np.amin(np.array([wv.ELLMAX, 3*N_side_temp-1]))
+        temp_alm = _map2alm(wv_maps[j], lmax=lmax_temp, iter=wv.analysis_iter)
+        temp_alm *= wv.filters[j][_l_of_alm(lmax_temp)]
+        out_map += _alm2map(temp_alm, N_side_out, out=map_buf)
     return out_map
 
-def waveletize_input_maps(info,scale_info_wvs,wv,map_images = False):
-        ##########################
-        # compute wavelet decomposition of all frequency maps used at each filter scale
-        # save the filtered maps (aka maps of "wavelet coefficients")
-        # remember to re-convolve all maps to the highest resolution map being used when passing into needlet filtering, or to the user-specified input beam at which to compute the ILC
-        # possibly make this a routine of the object scale_info_wvs ?
-
+# wavelet coefficient maps are always saved to disk, but if info.keep_wavelet_maps_in_memory is set they are also kept
+# in info.wavelet_maps_in_memory (keyed by file name), so that later steps do not have to read them back in from disk
+# they are stored in double precision, unless info.single_precision_wavelet_maps is set, which halves their size (on disk and
+# in memory); all computations using them are done in double precision either way, but since the per-pixel covariance matrices
+# can be poorly conditioned, rounding the maps to single precision can change the inverse covariance (and the ILC maps) noticeably
+def _save_wavelet_map(info, filename, wavelet_map):
+    dtype = np.float32 if info.single_precision_wavelet_maps else np.float64
+    wavelet_map = np.asarray(wavelet_map, dtype=dtype)
+    hp.write_map(filename, wavelet_map, nest=False, dtype=dtype, overwrite=False)
+    if info.keep_wavelet_maps_in_memory:
+        info.wavelet_maps_in_memory[filename] = wavelet_map
+
+# the covariance, inverse covariance and weight maps at each scale are written and read in one file per map; these FITS reads
+# and writes are independent of each other and mostly wait on disk I/O (which releases the GIL), so they are done in a thread pool
+def _write_maps(filenames, maps, dtype=np.float64, nthreads=8):
+    with ThreadPoolExecutor(max_workers=max(1, min(nthreads, len(filenames)))) as executor:
+        futures = [executor.submit(hp.write_map, filename, maps[count], nest=False, dtype=dtype, overwrite=False) for count, filename in enumerate(filenames)]
+        for future in futures:
+            future.result()
+
+# the maps are read directly into the rows of out, a preallocated (N_maps, N_pix) array, rather than stacked into a new array
+def _read_maps(filenames, out, nthreads=8):
+    def read_map(count):
+        out[count] = hp.read_map(filenames[count], dtype=out.dtype.type)
+    with ThreadPoolExecutor(max_workers=max(1, min(nthreads, len(filenames)))) as executor:
+        for _ in executor.map(read_map, range(len(filenames))):
+            pass
+    return out
+
+# read a (RING-ordered) map written by hp.write_map as a memory-mapped view of the FITS file, rather than copying it into memory:
+# the data are only paged in from disk when they are used
+def _read_map_memmap(filename):
+    with fits.open(filename, memmap=True) as hdul:
+        assert hdul[1].header['ORDERING'] == 'RING', "expected a RING-ordered map in "+filename
+        return hdul[1].data.field(0).ravel()
+
+# keep=False releases the in-memory copy once the last step that needs it has read it
+def _read_wavelet_map(info, filename, keep=True):
+    if filename in info.wavelet_maps_in_memory:
+        if keep:
+            return info.wavelet_maps_in_memory[filename]
+        return info.wavelet_maps_in_memory.pop(filename)
+    wavelet_map = _read_map_memmap(filename)
+    if keep and info.keep_wavelet_maps_in_memory:
+        info.wavelet_maps_in_memory[filename] = wavelet_map
+    return wavelet_map
+
+def _waveletize_freq(i,info,scale_info_wvs,wv,nthreads=None,alm_buf=None):
+        # compute (or read in) and save the wavelet coefficient maps of the i^th frequency map
+        # returns the wavelet coefficient maps, which are needed if images are requested
         freqs_to_use = scale_info_wvs.freqs_to_use
-        N_freqs_to_use = scale_info_wvs.N_freqs_to_use
-        FWHM_pix = scale_info_wvs.FWHM_pix
         N_side_to_use = scale_info_wvs.N_side_to_use
-        N_pix_to_use = scale_info_wvs.N_pix_to_use
-
-        for i in range(info.N_freqs):
-            # N.B. maps are assumed to be in strictly decreasing order of FWHM! i.e. info.beams[-1] is highest-resolution beam
-            print("waveletizing frequency ", i, "...")
-            wv_maps_temp = []
-            flag=True
+        # N.B. maps are assumed to be in strictly decreasing order of FWHM! i.e. info.beams[-1] is highest-resolution beam
+        print("waveletizing frequency ", i, "...")
+        wv_maps_temp = []
+        flag=True
+        for j in range(wv.N_scales):
+            if freqs_to_use[j][i] == True:
+                filename = info.output_dir+info.output_prefix+'_needletcoeffmap_freq'+str(i)+'_scale'+str(j)+'.fits'
+                exists = os.path.isfile(filename)
+                if exists:
+                    print('needlet coefficient map already exists:', filename)
+                    wv_maps_temp.append( _read_wavelet_map(info, filename) )
+                else:
+                    print('needlet coefficient map not previously computed; computing all maps for frequency '+str(i)+' now...')
+                    flag=False
+                    break
+        if flag == False:
+            waveletizer = wv.compile_waveletizer(rebeam=True, inp_beam=(info.beams)[i], new_beam=info.common_beam, wv_filts_to_use=freqs_to_use[:,i], N_side_to_use=N_side_to_use, nthreads=nthreads)
+            wv_maps_temp = waveletizer((info.maps)[i], alm_buf=alm_buf)
             for j in range(wv.N_scales):
                 if freqs_to_use[j][i] == True:
                     filename = info.output_dir+info.output_prefix+'_needletcoeffmap_freq'+str(i)+'_scale'+str(j)+'.fits'
-                    exists = os.path.isfile(filename)
-                    if exists:
-                        print('needlet coefficient map already exists:', filename)
-                        wv_maps_temp.append( hp.read_map(filename, dtype=np.float64) )
-                    else:
-                        print('needlet coefficient map not previously computed; computing all maps for frequency '+str(i)+' now...')
-                        flag=False
-                        break
-            if flag == False:
-                wv_maps_temp = waveletize(inp_map=(info.maps)[i], wv=wv, rebeam=True, inp_beam=(info.beams)[i], new_beam=info.common_beam, wv_filts_to_use=freqs_to_use[:,i], N_side_to_use=N_side_to_use)
+                    _save_wavelet_map(info, filename, wv_maps_temp[j])
+        print("done waveletizing frequency ", i, "...")
+        if info.cross_ILC:
+            season_waveletizer = None #both seasons are waveletized with the same settings
+            for season in [1,2]:
+                flag = True
+                season_maps_temp = []
                 for j in range(wv.N_scales):
                     if freqs_to_use[j][i] == True:
-                        filename = info.output_dir+info.output_prefix+'_needletcoeffmap_freq'+str(i)+'_scale'+str(j)+'.fits'
-                        hp.write_map(filename, wv_maps_temp[j], nest=False, dtype=np.float64, overwrite=False)
-            if map_images == True:
-                for j in range(wv.N_scales):
-                    if freqs_to_use[j][i] == True:
-                        plt.clf()
-                        hp.mollview(wv_maps_temp[j], unit="K", title="Needlet Coefficient Map, Frequency "+str(i)+" Scale "+str(j), min=np.mean(wv_maps_temp[j])-2*np.std(wv_maps_temp[j]), max=np.mean(wv_maps_temp[j])+2*np.std(wv_maps_temp[j]))
-                        plt.savefig(info.output_dir+info.output_prefix+'_needletcoeffmap_freq'+str(i)+'_scale'+str(j)+'.pdf')
-            print("done waveletizing frequency ", i, "...")
-            if info.cross_ILC:
-                for season in [1,2]:
-                    flag = True
-                    wv_maps_temp = []
-                    for j in range(wv.N_scales):
-                        if freqs_to_use[j][i] == True:
-                            filename = info.output_dir+info.output_prefix+'_needletcoeffmap_freq'+str(i)+'_scale'+str(j)+'_S'+str(season)+'.fits'
-                            exists = os.path.isfile(filename)
-                            if exists:
-                                print('needlet coefficient map already exists:', filename,)
-                                wv_maps_temp.append( hp.read_map(filename, dtype=np.float64, verbose=False) )
-                            else:
-                                print('needlet coefficient map not previously computed; computing all '+str(season)+'maps for frequency '+str(i)+' now...',)
-                                flag=False
-                                break
-                    if flag == False:
-                        if season==1:
-                            maps = info.maps_s1
-                        elif season==2:
-                            maps = info.maps_s2
+                        filename = info.output_dir+info.output_prefix+'_needletcoeffmap_freq'+str(i)+'_scale'+str(j)+'_S'+str(season)+'.fits'
+                        exists = os.path.isfile(filename)
+                        if exists:
+                            print('needlet coefficient map already exists:', filename,)
+                            season_maps_temp.append( _read_wavelet_map(info, filename) )
+                        else:
+                            print('needlet coefficient map not previously computed; computing all '+str(season)+'maps for frequency '+str(i)+' now...',)
+                            flag=False
+                            break
+                if flag == False:
+                    if season==1:
+                        maps = info.maps_s1
+                    elif season==2:
+                        maps = info.maps_s2
+                    if season_waveletizer is None:
                         if info.perform_ILC_at_beam is not None:
                             newbeam = info.common_beam
                         else:
                             newbeam = (info.beams)[-1]
-                        wv_maps_temp = waveletize(inp_map=(maps)[i], wv=wv, rebeam=True, inp_beam=(info.beams)[i], new_beam=newbeam, wv_filts_to_use=freqs_to_use[:,i], N_side_to_use=N_side_to_use)
-                        for j in range(wv.N_scales):
-                            if freqs_to_use[j][i] == True:
-                                filename = info.output_dir+info.output_prefix+'_needletcoeffmap_freq'+str(i)+'_scale'+str(j)+'_S'+str(season)+'.fits'
-                                exists2 = os.path.isfile(filename)
-                                if not exists2:
-                                    hp.write_map(filename, wv_maps_temp[j], nest=False, dtype=np.float64, overwrite=False)
-                        del(maps) #free up memory
-            del wv_maps_temp #free up memory
+                        season_waveletizer = wv.compile_waveletizer(rebeam=True, inp_beam=(info.beams)[i], new_beam=newbeam, wv_filts_to_use=freqs_to_use[:,i], N_side_to_use=N_side_to_use, nthreads=nthreads)
+                    season_maps_temp = season_waveletizer((maps)[i], alm_buf=alm_buf)
+                    for j in range(wv.N_scales):
+                        if freqs_to_use[j][i] == True:
+                            filename = info.output_dir+info.output_prefix+'_needletcoeffmap_freq'+str(i)+'_scale'+str(j)+'_S'+str(season)+'.fits'
+                            exists2 = os.path.isfile(filename)
+                            if not exists2:
+                                _save_wavelet_map(info, filename, season_maps_temp[j])
+                del season_maps_temp #free up memory
+        return wv_maps_temp
+
+def waveletize_input_maps(info,scale_info_wvs,wv,map_images = False):
+        ##########################
+        # compute wavelet decomposition of all frequency maps used at each filter scale
+        # save the filtered maps (aka maps of "wavelet coefficients")
+        # remember to re-convolve all maps to the highest resolution map being used when passing into needlet filtering, or to the user-specified input beam at which to compute the ILC
+        # possibly make this a routine of the object scale_info_wvs ?
+        # the frequencies are independent of each other, so info.N_waveletize_jobs of them are waveletized concurrently
+        # (in threads, which share info.maps; the SHTs release the GIL) and the info.N_threads threads are split between them
+        freqs_to_use = scale_info_wvs.freqs_to_use
+        N_jobs = min(info.N_waveletize_jobs, info.N_freqs)
+        nthreads = max(1, info.N_threads//N_jobs)
+        # each thread keeps one filtered-alm buffer that it reuses for all of the frequencies (and scales) it waveletizes
+        thread_buffers = threading.local()
+        def job(i):
+            if not hasattr(thread_buffers, 'alm_buf'):
+                thread_buffers.alm_buf = np.empty(hp.Alm.getsize(wv.ELLMAX), dtype=np.complex128)
+            return _waveletize_freq(i, info, scale_info_wvs, wv, nthreads=nthreads, alm_buf=thread_buffers.alm_buf)
+        with ThreadPoolExecutor(max_workers=N_jobs) as executor:
+            all_wv_maps = executor.map(job, range(info.N_freqs))
+            for i, wv_maps_temp in enumerate(all_wv_maps):
+                # matplotlib is not thread-safe, so the images are made here rather than in the jobs
+                if map_images == True:
+                    for j in range(wv.N_scales):
+                        if freqs_to_use[j][i] == True:
+                            plt.clf()
+                            hp.mollview(wv_maps_temp[j], unit="K", title="Needlet Coefficient Map, Frequency "+str(i)+" Scale "+str(j), min=np.mean(wv_maps_temp[j])-2*np.std(wv_maps_temp[j]), max=np.mean(wv_maps_temp[j])+2*np.std(wv_maps_temp[j]))
+                            plt.savefig(info.output_dir+info.output_prefix+'_needletcoeffmap_freq'+str(i)+'_scale'+str(j)+'.pdf')
+                del wv_maps_temp #free up memory
+
+# mixing matrix A_{i\alpha}: the alpha^th component's SED evaluated at the i^th frequency used at this scale,
+# with the preserved component first and then the deprojected components (in that order)
+# the SED parameter file is read once, and each component's SED is evaluated at all frequencies in a single call
+def _mixing_matrix(info, freqs_to_use_at_scale, ILC_deproj_comps):
+    freqs = np.flatnonzero(freqs_to_use_at_scale)
+    param_dict = read_param_dict_from_yaml(info.param_dict_file)
+    A_mix = np.zeros((len(freqs), len(ILC_deproj_comps)+1))
+    for b, comp in enumerate([info.ILC_preserved_comp]+list(ILC_deproj_comps)):
+        # N.B. get_mix and get_mix_bandpassed assume the input maps are in uK_CMB, i.e., responses are computed in uK_CMB, but we are assuming in this code that all maps are in K_CMB, hence factor of 1.e-6 below
+        # However, note that as a consequence an output NILC CMB map from this code has units of uK_CMB!
+        if (info.bandpass_type == 'DeltaBandpasses'):
+            A_mix[:,b] = 1.e-6 * get_mix([info.freqs_delta_ghz[a] for a in freqs], comp, param_dict_file=None, param_dict_override=param_dict, dust_beta_param_name='beta_CIB', radio_beta_param_name='beta_radio') #convert to K from uK
+        elif (info.bandpass_type == 'ActualBandpasses'):
+            A_mix[:,b] = 1.e-6 * get_mix_bandpassed([info.freq_bp_files[a] for a in freqs], comp, param_dict_file=None, param_dict_override=param_dict, dust_beta_param_name='beta_CIB', radio_beta_param_name='beta_radio') #convert to K from uK
+    # normalize the columns of A_mix corresponding to the deprojected components so that they have values near unity
+    A_mix[:,1:] /= np.amax(A_mix[:,1:], axis=0)
+    return A_mix
+
+# the frequencies used at a scale, and the pairs of them for which covariance maps are computed, as indices (ia, ib) into freqs
+# the pairs are the upper triangle in the order 00, 01, 02, ..., 11, 12, ...; for cross-ILC the S1 x S2 covariance is not
+# symmetric, so all pairs 00, 01, ..., 10, 11, ... are used
+def _freq_pairs(info, freqs_to_use_at_scale, cross_ILC=None):
+    if cross_ILC is None:
+        cross_ILC = info.cross_ILC
+    freqs = np.flatnonzero(freqs_to_use_at_scale)
+    if cross_ILC:
+        ia, ib = np.indices((len(freqs), len(freqs))).reshape(2,-1)
+    else:
+        ia, ib = np.triu_indices(len(freqs))
+    return freqs, ia, ib
 
 def compute_covariance_at_scale(info,scale,FWHM_pix,scale_info_wvs):
     j = scale
-    cov_maps_temp=[]
-    for a in range(info.N_freqs):
-                    start_at = a
-                    if info.cross_ILC:
-                        start_at = 0
-                    for b in range(start_at, info.N_freqs):
-                        if (scale_info_wvs.freqs_to_use[j][a] == True) and (scale_info_wvs.freqs_to_use[j][b] == True):
-                            cov_filename = _cov_filename(info,a,b,j)
-                            # read in wavelet coefficient maps constructed in previous step above
-                            if not info.cross_ILC:
-                                filename_A = info.output_dir+info.output_prefix+'_needletcoeffmap_freq'+str(a)+'_scale'+str(j)+'.fits'
-                                filename_B = info.output_dir+info.output_prefix+'_needletcoeffmap_freq'+str(b)+'_scale'+str(j)+'.fits'
-                            else:
-                                filename_A = info.output_dir+info.output_prefix+'_needletcoeffmap_freq'+str(a)+'_scale'+str(j)+'_S1.fits'
-                                filename_B = info.output_dir+info.output_prefix+'_needletcoeffmap_freq'+str(b)+'_scale'+str(j)+'_S2.fits'
-                            wavelet_map_A = hp.read_map(filename_A, dtype=np.float64, verbose=False)
-                            wavelet_map_B = hp.read_map(filename_B, dtype=np.float64, verbose=False)
-                            assert len(wavelet_map_A) == len(wavelet_map_B), "cov mat map calculation: wavelet coefficient maps have different N_side"
-                            # first perform smoothing operation to get the "mean" maps
-                            wavelet_map_A_smoothed = hp.sphtfunc.smoothing(wavelet_map_A, FWHM_pix[j])
-                            wavelet_map_B_smoothed = hp.sphtfunc.smoothing(wavelet_map_B, FWHM_pix[j])
-                            # then construct the smoothed real-space freq-freq cov matrix element for this pair of frequency maps
-                            # note that the overall normalization of this cov matrix is irrelevant for the ILC weight calculation (it always cancels out)
-                            cov_map_temp = hp.sphtfunc.smoothing( (wavelet_map_A - wavelet_map_A_smoothed)*(wavelet_map_B - wavelet_map_B_smoothed) , FWHM_pix[j])
-                            cov_maps_temp.append( cov_map_temp )
-                            hp.write_map(cov_filename, cov_map_temp, nest=False, dtype=np.float64, overwrite=False)
+    freqs, ia, ib = _freq_pairs(info, scale_info_wvs.freqs_to_use[j])
+    # read in wavelet coefficient maps constructed in previous step above
+    if not info.cross_ILC:
+        filenames_A = [info.output_dir+info.output_prefix+'_needletcoeffmap_freq'+str(a)+'_scale'+str(j)+'.fits' for a in freqs]
+        filenames_B = None
+    else:
+        filenames_A = [info.output_dir+info.output_prefix+'_needletcoeffmap_freq'+str(a)+'_scale'+str(j)+'_S1.fits' for a in freqs]
+        filenames_B = [info.output_dir+info.output_prefix+'_needletcoeffmap_freq'+str(b)+'_scale'+str(j)+'_S2.fits' for b in freqs]
+    # first perform smoothing operation to get the "mean" maps, and subtract them
+    # each map is smoothed once here, rather than once for every pair of frequencies it appears in
+    # (the season maps of a cross-ILC are not needed again after this, unlike the full maps)
+    wavelet_maps_A = np.array([_read_wavelet_map(info, filename, keep=not info.cross_ILC) for filename in filenames_A], dtype=np.float64)
+    wavelet_maps_A -= _smooth_maps(wavelet_maps_A, FWHM_pix[j], iter=info.analysis_iter, nthreads=info.N_threads)
+    if filenames_B is None:
+        wavelet_maps_B = wavelet_maps_A
+    else:
+        wavelet_maps_B = np.array([_read_wavelet_map(info, filename, keep=False) for filename in filenames_B], dtype=np.float64)
+        wavelet_maps_B -= _smooth_maps(wavelet_maps_B, FWHM_pix[j], iter=info.analysis_iter, nthreads=info.N_threads)
+    assert wavelet_maps_A.shape == wavelet_maps_B.shape, "cov mat map calculation: wavelet coefficient maps have different N_side"
+    # then construct the smoothed real-space freq-freq cov matrix elements for all pairs of frequencies
+    # note that the overall normalization of this cov matrix is irrelevant for the ILC weight calculation (it always cancels out)
+    # the pairs are smoothed in chunks of N_freqs products per batched transform: this keeps the SHT work shared within a chunk, while
+    # the transforms' temporary map and alm stacks stay at O(N_freqs) maps rather than O(N_freqs^2); each chunk of products is
+    # written into one reused buffer and its smoothed maps straight into the preallocated output
+    N_pix = wavelet_maps_A.shape[-1]
+    chunk_size = len(freqs)
+    cov_maps_temp = np.empty((len(ia), N_pix))
+    cov_prods = np.empty((chunk_size, N_pix))
+    for start in range(0, len(ia), chunk_size):
+        stop = min(start+chunk_size, len(ia))
+        for count in range(start, stop):
+            np.multiply(wavelet_maps_A[ia[count]], wavelet_maps_B[ib[count]], out=cov_prods[count-start])
+        _smooth_maps(cov_prods[:stop-start], FWHM_pix[j], iter=info.analysis_iter, nthreads=info.N_threads, out=cov_maps_temp[start:stop])
+    del cov_prods
+    _write_maps([_cov_filename(info,freqs[ia[count]],freqs[ib[count]],j) for count in range(len(ia))], cov_maps_temp)
     print('done computing all covariance maps at scale'+str(j),flush=True)
     return cov_maps_temp
 
+# invert a (N_pix, N_freqs, N_freqs) stack of cov matrices; np.linalg.inv loops over the pixels in a single thread (and releases
+# the GIL while doing so), so the pixels are split into blocks that are inverted concurrently in a thread pool
+def _invert_covmat(covmat, nthreads=None):
+    if nthreads is None:
+        nthreads = os.cpu_count()
+    inv_covmat = np.empty_like(covmat)
+    blocks = [block for block in np.array_split(np.arange(covmat.shape[0]), nthreads) if len(block) > 0]
+    def invert_block(block):
+        inv_covmat[block[0]:block[-1]+1] = np.linalg.inv(covmat[block[0]:block[-1]+1])
+    with ThreadPoolExecutor(max_workers=len(blocks)) as executor:
+        for _ in executor.map(invert_block, blocks):
+            pass
+    return inv_covmat
+
+# response has dimensions N_comps x N_pix; the preserved component should have response 1 and the deprojected components response 0
+# only the maximum deviation over all pixels is compared with the tolerance (written as "not <" so that NaN weights fail the check too)
+def _check_response(response, scale, resp_tol):
+    j = scale
+    max_err_preserved = np.amax(np.absolute(response[0]-1.0))
+    if not (max_err_preserved < resp_tol):
+        raise ResponseCheckError(f'preserved component response failed at wavelet scale {j}: max deviation {max_err_preserved} (tol is {resp_tol})')
+    if len(response) > 1:
+        max_err_deproj = np.amax(np.absolute(response[1:]))
+        if not (max_err_deproj < resp_tol):
+            raise ResponseCheckError(f'deprojected component response failed at wavelet scale {j}: max deviation {max_err_deproj} (tol is {resp_tol})')
+
 def compute_weights_at_scale(info,scale,inv_cov_maps_temp,A_mix,scale_info_wvs,resp_tol):
     j = scale
     if type(info.N_deproj) is int:
@@ -465,48 +709,28 @@ def compute_weights_at_scale(info,scale,inv_cov_maps_temp,A_mix,scale_info_wvs,r
     N_pix_to_use = scale_info_wvs.N_pix_to_use
     N_freqs_to_use = scale_info_wvs.N_freqs_to_use
     freqs_to_use = scale_info_wvs.freqs_to_use
-    for a in range(info.N_freqs):
-        if (freqs_to_use[j][a] == True):
-            a_min = a
-            break
-    ### for each filter scale, perform cov matrix inversion and compute maps of the ILC weights using the inverted cov matrix maps
-    weights = np.zeros((int(N_pix_to_use[j]),int(N_freqs_to_use[j])))
 
     ### construct the matrix Q_{alpha beta} defined in Eq. 30 of McCarthy & Hill 2023 for each pixel at this wavelet scale and evaluate Eq. 29 to get weights ###
-    inv_covmat_temp = np.zeros((int(N_freqs_to_use[j]),int(N_freqs_to_use[j]), int(N_pix_to_use[j])))
-    count=0
-    for a in range(info.N_freqs):
-        for b in range(a, info.N_freqs):
-            if (freqs_to_use[j][a] == True) and (freqs_to_use[j][b] == True):
-                # inv_cov_maps_temp is in order 00, 01, 02, ..., 0(N_freqs_to_use[j]-1), 11, 12, ..., 1(N_freqs_to_use[j]-1), 22, 23, ...
-                inv_covmat_temp[a-a_min][b-a_min] = inv_cov_maps_temp[count] #by construction we're going through inv_cov_maps_temp in the same order as it was populated when computed (see below)
-                if (a-a_min) != (b-a_min):
-                    inv_covmat_temp[b-a_min][a-a_min] = inv_covmat_temp[a-a_min][b-a_min] #symmetrize
-                count+=1
-    tmp1 = np.einsum('ai,jip->ajp', np.transpose(A_mix), inv_covmat_temp)
-    Qab_pix = np.einsum('ajp,bj->abp', tmp1, np.transpose(A_mix))
+    # inv_cov_maps_temp holds the upper triangle of the (symmetric) inverse cov matrix, in the order of the pairs (ia, ib) given by _freq_pairs
+    freqs, ia, ib = _freq_pairs(info, freqs_to_use[j], cross_ILC=False)
+    # the inverse cov matrix is unpacked pixel-major, i.e. as a (N_pix, N_freqs, N_freqs) stack, so that Q and the weights are batched matrix products (BLAS gemm per pixel)
+    inv_covmat_temp = np.zeros((int(N_pix_to_use[j]), int(N_freqs_to_use[j]),int(N_freqs_to_use[j])))
+    inv_covmat_temp[:,ia,ib] = inv_cov_maps_temp.T
+    inv_covmat_temp[:,ib,ia] = inv_cov_maps_temp.T #symmetrize
+    # Q = A^T C^-1 A for all pixels at once, without materializing the intermediate (N_comps, N_freqs, N_pix) array
+    # Q is a (N_pix, N_comps, N_comps) stack, so that the linear solve below is batched over pixels
+    A_mix_T = np.ascontiguousarray(A_mix.T) #contiguous copy, so that the batched products below run on a C-ordered operand
+    Qab_pix = np.matmul(np.matmul(A_mix_T, inv_covmat_temp), A_mix)
     # compute weights
-    tempvec = np.zeros((N_comps, int(N_pix_to_use[j])))
-    # treat the no-deprojection case separately, since QSa_temp is empty in this case
-    if (N_comps == 1):
-        tempvec[0] = [1.0]*int(N_pix_to_use[j])
-    else:
-        for a in range(N_comps):
-            QSa_temp = np.delete(np.delete(Qab_pix, a, 0), 0, 1) #remove the a^th row and zero^th column
-            tempvec[a] = (-1.0)**float(a) * np.linalg.det(np.transpose(QSa_temp,(2,0,1)))
-    tmp2 = np.einsum('ia,ap->ip', A_mix, tempvec)
-    tmp3 = np.einsum('jip,ip->jp', inv_covmat_temp, tmp2)
-    weights = 1.0/np.linalg.det(np.transpose(Qab_pix,(2,0,1)))[:,None]*np.transpose(tmp3) #N.B. 'weights' here only includes channels that passed beam_thresh criterion,
+    # Eq. 29 (the cofactors of Q divided by det Q) is the first row of Q^-1, so the weights are w = C^-1 A Q^-1 e_0,
+    # where e_0 selects the preserved component; this needs one batched LU solve per pixel instead of N_comps+1 determinants
+    e0 = np.zeros((int(N_pix_to_use[j]), N_comps, 1))
+    e0[:,0] = 1.0
+    lam = np.linalg.solve(Qab_pix, e0) #dimensions N_pix x N_comps x 1
+    weights = np.matmul(inv_covmat_temp, np.matmul(A_mix, lam))[:,:,0] #N.B. 'weights' here only includes channels that passed beam_thresh criterion,
     # response verification
     response = np.einsum('pi,ia->ap', weights, A_mix) #dimensions N_comps x N_pix_to_use[j]
-    optimal_response_preserved_comp = np.ones(int(N_pix_to_use[j]))  #preserved component, want response=1
-    optimal_response_deproj_comp = np.zeros((N_comps-1, int(N_pix_to_use[j]))) #deprojected components, want response=0
-    if not (np.absolute(response[0]-optimal_response_preserved_comp) < resp_tol).all():
-        print(f'preserved component response failed at wavelet scale {j}')
-        quit()
-    if not (np.absolute(response[1:]-optimal_response_deproj_comp) < resp_tol).all():
-        print(f'deprojected component response failed at wavelet scale {j}')
-        quit()
+    _check_response(response, j, resp_tol)
     return weights 
 
 def _cov_filename(info,freq1,freq2,scale):
@@ -538,17 +762,32 @@ def _inv_cov_filename(info,scale,freq1,freq2):
                     inv_cov_filename = info.output_dir+info.output_prefix+'_needletcoeff_invcovmap_freq'+str(a)+'_freq'+str(b)+'_scale'+str(j)+'_crossILC'*info.cross_ILC+'_Ndeproj'+str(N_deproj)+'.fits'
     return inv_cov_filename
 
+# all of the (upper triangle) inverse cov maps at a scale are saved together in one (uncompressed) .npy file, rather than one FITS
+# file per pair; the frequencies used at the scale are saved next to it, in the same file name ending in _freqs.npy
+def _inv_cov_store_filename(info,scale):
+    j = scale
+    inv_cov_filename = info.output_dir+info.output_prefix+'_needletcoeff_invcovmaps_scale'+str(j)+'_crossILC'*info.cross_ILC+'.npy'
+    if info.recompute_covmat_for_ndeproj:
+                    if type(info.N_deproj) is int:
+                        N_deproj = info.N_deproj
+                    else:
+                        N_deproj = info.N_deproj[j]
+                    inv_cov_filename = info.output_dir+info.output_prefix+'_needletcoeff_invcovmaps_scale'+str(j)+'_crossILC'*info.cross_ILC+'_Ndeproj'+str(N_deproj)+'.npy'
+    return inv_cov_filename
 
+
+# freq=None gives the name of the file holding the weights of all frequencies at the scale (see _weights_store_filename)
 def _weights_filename(info,freq,scale):
                 a = freq
                 j = scale
-                weight_filename = info.output_dir+info.output_prefix+'weightmap_freq'+str(a)+'_scale'+str(j)+'_component_'+info.ILC_preserved_comp+'_crossILC'*info.cross_ILC+'.fits'
+                weightmap_name = 'weightmap_freq'+str(a) if freq is not None else 'weightmaps'
+                weight_filename = info.output_dir+info.output_prefix+weightmap_name+'_scale'+str(j)+'_component_'+info.ILC_preserved_comp+'_crossILC'*info.cross_ILC+'.fits'
                 if type(info.N_deproj )is int:
                     if info.N_deproj>0:
-                        weight_filename = info.output_dir+info.output_prefix+'weightmap_freq'+str(a)+'_scale'+str(j)+'_component_'+info.ILC_preserved_comp+'_deproject_'+'_'.join(info.ILC_deproj_comps)+'_crossILC'*info.cross_ILC+'.fits'
+                        weight_filename = info.output_dir+info.output_prefix+weightmap_name+'_scale'+str(j)+'_component_'+info.ILC_preserved_comp+'_deproject_'+'_'.join(info.ILC_deproj_comps)+'_crossILC'*info.cross_ILC+'.fits'
                 else:
                     if info.N_deproj[j]>0:
-                        weight_filename = info.output_dir+info.output_prefix+'weightmap_freq'+str(a)+'_scale'+str(j)+'_component_'+info.ILC_preserved_comp+'_deproject_'+'_'.join(info.ILC_deproj_comps[j])+'_crossILC'*info.cross_ILC+'.fits'
+                        weight_filename = info.output_dir+info.output_prefix+weightmap_name+'_scale'+str(j)+'_component_'+info.ILC_preserved_comp+'_deproject_'+'_'.join(info.ILC_deproj_comps[j])+'_crossILC'*info.cross_ILC+'.fits'
                 if info.recompute_covmat_for_ndeproj:
                     if type(info.N_deproj) is int:
                         N_deproj = info.N_deproj
@@ -559,6 +798,11 @@ def _weights_filename(info,freq,scale):
                 weight_filename = weight_filename[:-5]+info.output_suffix+'.fits'
                 return weight_filename
 
+# the ILC weights of all frequencies at a scale are always saved together in one .npy file (in addition to the per-frequency
+# FITS files written if save_weights is set), so that reruns with the same settings do not have to recompute them
+def _weights_store_filename(info,scale):
+    return _weights_filename(info,None,scale)[:-5]+'.npy'
+
 def _ILC_map_filename(info):
     ILC_map_filename = info.output_dir+info.output_prefix+'needletILCmap'+'_component_'+info.ILC_preserved_comp+'_crossILC'*info.cross_ILC+info.output_suffix+'.fits'
     if type(info.N_deproj) is int:
@@ -609,7 +853,7 @@ def wavelet_ILC(wv=None, info=None,  resp_tol=1.e-3, map_images=False):
          maps_for_weights_needlets=[]
          for i in range(info.N_freqs):
              print("waveletizing maps to apply weights", i)
-             maps_for_weights_needlets.append(waveletize(inp_map=(info.maps_for_weights)[i], wv=wv, rebeam=True, inp_beam=(info.beams)[i], new_beam=newbeam, wv_filts_to_use=freqs_to_use[:,i], N_side_to_use=N_side_to_use))
+             maps_for_weights_needlets.append(waveletize(inp_map=(info.maps_for_weights)[i], wv=wv, rebeam=True, inp_beam=(info.beams)[i], new_beam=newbeam, wv_filts_to_use=freqs_to_use[:,i], N_side_to_use=N_side_to_use, nthreads=info.N_threads))
              print("waveletized ", i)
     else:
         print("not waveletizing any other maps")
@@ -624,6 +868,7 @@ def wavelet_ILC(wv=None, info=None,  resp_tol=1.e-3, map_images=False):
     for j in range(wv.N_scales):
         # first, check if the weights already exist, and skip everything if so
 
+        ILC_deproj_comps = []
         if type(info.N_deproj) is int:
             N_deproj = info.N_deproj
             if N_deproj>0:
@@ -633,18 +878,26 @@ def wavelet_ILC(wv=None, info=None,  resp_tol=1.e-3, map_images=False):
             if N_deproj>0:
                 ILC_deproj_comps = info.ILC_deproj_comps[j]
 
+        # if info.cache_weights is set, the weights of all frequencies at this scale are also saved in one .npy file, along with the
+        # frequencies and mixing matrix used to compute them (saved after the weights, so they only exist if the weights were saved completely)
+        weights_store_filename = _weights_store_filename(info,j)
+        weights_mix_filename = weights_store_filename[:-4]+'_mix.npz'
+        weights_stored = info.cache_weights and os.path.isfile(weights_mix_filename)
         weights_exist = True
-        count=0
-        for a in range(info.N_freqs):
-            if (freqs_to_use[j][a] == True):
-                weight_filename = _weights_filename(info,a,j)
-                exists = os.path.isfile(weight_filename)
-                if exists:
-                    print('weight map already exists:', weight_filename)
-                    count += 1
-                else:
-                    weights_exist = False
-                    break
+        if weights_stored:
+            print('weight maps already exist:', weights_store_filename)
+        else:
+            count=0
+            for a in range(info.N_freqs):
+                if (freqs_to_use[j][a] == True):
+                    weight_filename = _weights_filename(info,a,j)
+                    exists = os.path.isfile(weight_filename)
+                    if exists:
+                        print('weight map already exists:', weight_filename)
+                        count += 1
+                    else:
+                        weights_exist = False
+                        break
 
         if (weights_exist == False):
             ### compute the mixing matrix A_{i\alpha} ###
@@ -652,147 +905,95 @@ def wavelet_ILC(wv=None, info=None,  resp_tol=1.e-3, map_images=False):
             # units of A_mix are K_CMB
             # Note: only include channels that are being used for this filter scale
             N_comps = (N_deproj + 1)
-            A_mix = np.zeros((int(N_freqs_to_use[j]),N_comps))
-            countt = 0
-            for a in range(info.N_freqs):
-                if (freqs_to_use[j][a] == True):
-                    for b in range(N_comps):
-                        if (b == 0): # zero^th component is special (this is the one being preserved in the ILC)
-                            if (info.bandpass_type == 'DeltaBandpasses'):
-                                # N.B. get_mix and get_mix_bandpassed assume the input maps are in uK_CMB, i.e., responses are computed in uK_CMB, but we are assuming in this code that all maps are in K_CMB, hence factor of 1.e-6 below
-                                # However, note that as a consequence an output NILC CMB map from this code has units of uK_CMB!
-                                A_mix[countt][b] = 1.e-6 * (get_mix([info.freqs_delta_ghz[a]], info.ILC_preserved_comp, param_dict_file=info.param_dict_file, param_dict_override=None, dust_beta_param_name='beta_CIB', radio_beta_param_name='beta_radio'))[0] #convert to K from uK
-                            elif (info.bandpass_type == 'ActualBandpasses'):
-                                A_mix[countt][b] = 1.e-6 * (get_mix_bandpassed([info.freq_bp_files[a]], info.ILC_preserved_comp, param_dict_file=info.param_dict_file, param_dict_override=None, dust_beta_param_name='beta_CIB', radio_beta_param_name='beta_radio'))[0] #convert to K from uK
-                        else:
-                            if (info.bandpass_type == 'DeltaBandpasses'):
-                                A_mix[countt][b] = 1.e-6 * (get_mix([info.freqs_delta_ghz[a]], ILC_deproj_comps[b-1], param_dict_file=info.param_dict_file, param_dict_override=None, dust_beta_param_name='beta_CIB', radio_beta_param_name='beta_radio'))[0] #convert to K from uK
-                            elif (info.bandpass_type == 'ActualBandpasses'):
-                                A_mix[countt][b] = 1.e-6 * (get_mix_bandpassed([info.freq_bp_files[a]], ILC_deproj_comps[b-1], param_dict_file=info.param_dict_file, param_dict_override=None, dust_beta_param_name='beta_CIB', radio_beta_param_name='beta_radio'))[0] #convert to K from uK
-                    countt += 1
-            # normalize the columns of A_mix corresponding to the deprojected components so that they have values near unity
-            if (N_deproj != 0):
-                for b in range(1,N_deproj+1):
-                    max_temp = np.amax(A_mix[:,b])
-                    A_mix[:,b] = A_mix[:,b]/max_temp
+            A_mix = _mixing_matrix(info, freqs_to_use[j], ILC_deproj_comps[:N_deproj])
             ##############################
             ##############################
             # for each filter scale, compute maps of the smoothed real-space frequency-frequency covariance matrix using the Gaussians determined above
-            cov_maps_temp = []
-            flag=True
-            for a in range(info.N_freqs):
-                    start_at = a
-                    if info.cross_ILC:
-                        start_at = 0
-                    for b in range(start_at, info.N_freqs):
-                        if (freqs_to_use[j][a] == True) and (freqs_to_use[j][b] == True and flag==True):
-                            cov_filename = _cov_filename(info,a,b,j)
-                            exists = os.path.isfile(cov_filename)
-                            if exists:
-                                if not info.inv_covmat_exists:
-                                    print('needlet coefficient covariance map already exists:', cov_filename)
-                                    cov_maps_temp.append( hp.read_map(cov_filename, dtype=np.float64) )
-                                else:
-                                    cov_maps_temp.append(0)
-
-                            else:
-                                print('needlet coefficient covariance map not previously computed; computing all covariance maps at scale '+str(j)+' now...')
-                                flag=False
-                                break
-            if flag == False:
-                    cov_maps_temp = compute_covariance_at_scale(info,j,FWHM_pix,scale_info_wvs)
+            freqs, ia, ib = _freq_pairs(info, freqs_to_use[j])
+            cov_filenames = [_cov_filename(info,freqs[ia[count]],freqs[ib[count]],j) for count in range(len(ia))]
+            if all(map(os.path.isfile, cov_filenames)):
+                if not info.inv_covmat_exists:
+                    for cov_filename in cov_filenames:
+                        print('needlet coefficient covariance map already exists:', cov_filename)
+                    cov_maps_temp = _read_maps(cov_filenames, np.zeros((len(cov_filenames), int(N_pix_to_use[j]))))
+                else:
+                    cov_maps_temp = None
+            else:
+                print('needlet coefficient covariance map not previously computed; computing all covariance maps at scale '+str(j)+' now...')
+                cov_maps_temp = compute_covariance_at_scale(info,j,FWHM_pix,scale_info_wvs)
             ##########################
             ##########################
             # invert the cov matrix in each pixel for each filter scale
-            inv_cov_maps_temp = np.zeros((len(cov_maps_temp), int((N_pix_to_use[j]))))
-            # determine lowest-resolution frequency used in the analysis for this scale -- N.B. freq maps are assumed to be in order from lowest to highest resolution (as elsewhere in the code)
-            for a in range(info.N_freqs):
-                if (freqs_to_use[j][a] == True):
-                    a_min = a
-                    break
+            # the inverse covariance matrix is always symmetric, so only its upper triangle is stored
+            freqs, ia_inv, ib_inv = _freq_pairs(info, freqs_to_use[j], cross_ILC=False)
+            # they are saved in one .npy file per scale (along with the frequencies used), which is read back in as a memory-mapped view
+            # rather than copied into memory; inverse cov maps saved as one FITS file per pair by earlier versions of the code are still
+            # read in if they exist
+            inv_cov_store_filename = _inv_cov_store_filename(info,j)
+            inv_cov_freqs_filename = inv_cov_store_filename[:-4]+'_freqs.npy'
+            inv_cov_filenames = [_inv_cov_filename(info,j,freqs[ia_inv[count]],freqs[ib_inv[count]]) for count in range(len(ia_inv))]
             ### for each filter scale, perform cov matrix inversion and compute maps of the ILC weights using the inverted cov matrix maps
-            weights = np.zeros((int(N_pix_to_use[j]),int(N_freqs_to_use[j])))
-            flag=True #flag for whether inverse covariance maps already exist
-            count=0
-            for a in range(info.N_freqs):
-                for b in range(a, info.N_freqs):
-                    if (freqs_to_use[j][a] == True) and (freqs_to_use[j][b] == True and flag==True):
-                        inv_cov_filename = _inv_cov_filename(info,j,a,b)
-                        exists = os.path.isfile(inv_cov_filename)
-                        if exists:
-                            print('needlet coefficient inverse covariance map already exists:', inv_cov_filename)
-                            inv_cov_maps_temp[count] = hp.read_map(inv_cov_filename, dtype=np.float64) #by construction we're going through cov_maps_temp in the same order as it was populated above
-                            count+=1
-                        else:
-                            print('needlet coefficient inverse covariance map not previously computed; computing all inverse covariance maps at scale '+str(j)+' now...')
-                            flag=False
-                            break
+            flag = True #flag for whether inverse covariance maps already exist
+            # the frequencies are saved after the maps, so they only exist if the maps were saved completely
+            if os.path.isfile(inv_cov_freqs_filename):
+                print('needlet coefficient inverse covariance maps already exist:', inv_cov_store_filename)
+                assert np.array_equal(np.load(inv_cov_freqs_filename), freqs), "frequencies used in "+inv_cov_store_filename+" do not match those used at scale "+str(j)
+                inv_cov_maps_temp = np.load(inv_cov_store_filename, mmap_mode='r')
+                assert inv_cov_maps_temp.shape == (len(ia_inv), int(N_pix_to_use[j])), "inverse covariance maps in "+inv_cov_store_filename+" do not match the pixels used at scale "+str(j)
+            elif all(map(os.path.isfile, inv_cov_filenames)):
+                for inv_cov_filename in inv_cov_filenames:
+                    print('needlet coefficient inverse covariance map already exists:', inv_cov_filename)
+                inv_cov_maps_temp = _read_maps(inv_cov_filenames, np.zeros((len(ia_inv), int(N_pix_to_use[j]))))
+            else:
+                flag = False
+                inv_cov_maps_temp = np.zeros((len(ia_inv), int(N_pix_to_use[j])))
+                print('needlet coefficient inverse covariance map not previously computed; computing all inverse covariance maps at scale '+str(j)+' now...')
             if (flag==True):
-                ### construct the matrix Q_{alpha beta} defined in Eq. 30 of McCarthy & Hill 2023 for each pixel at this wavelet scale and evaluate Eq. 29 to get weights ###
-                inv_covmat_temp = np.zeros((int(N_freqs_to_use[j]),int(N_freqs_to_use[j]), int(N_pix_to_use[j])))
-                count=0
-                for a in range(info.N_freqs):
-                    for b in range(a, info.N_freqs):
-                        if (freqs_to_use[j][a] == True) and (freqs_to_use[j][b] == True):
-                            # inv_cov_maps_temp is in order 00, 01, 02, ..., 0(N_freqs_to_use[j]-1), 11, 12, ..., 1(N_freqs_to_use[j]-1), 22, 23, ...
-                            inv_covmat_temp[a-a_min][b-a_min] = inv_cov_maps_temp[count] #by construction we're going through inv_cov_maps_temp in the same order as it was populated when computed (see below)
-                            if (a-a_min) != (b-a_min):
-                                inv_covmat_temp[b-a_min][a-a_min] = inv_covmat_temp[a-a_min][b-a_min] #symmetrize
-                            count+=1
                 weights = compute_weights_at_scale(info,j,inv_cov_maps_temp,A_mix,scale_info_wvs,resp_tol)
 
             ##########
             ### if inverse covariance maps don't already exist ###
             if (flag == False):
-                covmat = np.zeros((int(N_freqs_to_use[j]),int(N_freqs_to_use[j]), int(N_pix_to_use[j])))
-                count=0
-                for a in range(info.N_freqs):
-                    start_at = a
-                    if info.cross_ILC:
-                        start_at = 0
-                    for b in range(start_at, info.N_freqs):
-                        if (freqs_to_use[j][a] == True) and (freqs_to_use[j][b] == True):
-                            # cov_maps_temp is in order 00, 01, 02, ..., 0(N_freqs_to_use[j]-1), 11, 12, ..., 1(N_freqs_to_use[j]-1), 22, 23, ...
-                            covmat[a-a_min][b-a_min] = cov_maps_temp[count] #by construction we're going through cov_maps_temp in the same order as it was populated above
-                            # TODO: maybe symmetrize it before saving so that we don't have to save twice as many covmats?
-                            if (a-a_min) != (b-a_min) and not info.cross_ILC:
-                                covmat[b-a_min][a-a_min] = covmat[a-a_min][b-a_min] #symmetrize
-                            count+=1
+                # the cov matrix is assembled directly as a (pixel, freq, freq) stack, so that np.linalg.inv can invert all pixels in one batched call without transposed copies
+                covmat = np.zeros((int(N_pix_to_use[j]), int(N_freqs_to_use[j]),int(N_freqs_to_use[j])))
+                # cov_maps_temp is in the order of the pairs (ia, ib) given by _freq_pairs
+                # TODO: maybe symmetrize it before saving so that we don't have to save twice as many covmats?
+                covmat[:,ia,ib] = np.transpose(cov_maps_temp)
+                if not info.cross_ILC:
+                    covmat[:,ib,ia] = np.transpose(cov_maps_temp) #symmetrize
                 # cross-ILC : symmetrize the covmat 
                 if info.cross_ILC:
-                    covmat = (covmat + np.transpose(covmat,(1,0,2)))/2
-                inv_covmat = np.linalg.inv(np.transpose(covmat,(2,0,1)))
-                inv_covmat = np.transpose(inv_covmat, axes=[1,2,0]) #new dim freq, freq, pix
+                    covmat = (covmat + np.transpose(covmat,(0,2,1)))/2
+                inv_covmat = _invert_covmat(covmat, nthreads=info.N_threads) #dim pix, freq, freq
 
-                assert np.allclose(np.einsum('ijp,jkp->pik', inv_covmat, covmat), np.transpose(np.repeat(np.eye(N_freqs_to_use[j])[:,:,None],N_pix_to_use[j],axis=2),(2,0,1)), rtol=1.e-2, atol=1.e-2), "covmat inversion failed for scale "+str(j) #, covmat, inv_covmat, np.dot(inv_covmat, covmat)-np.eye(int(N_freqs_to_use[j]))
-                count=0
-                for a in range(info.N_freqs):
-                    for b in range(a, info.N_freqs):
-                        if (freqs_to_use[j][a] == True) and (freqs_to_use[j][b] == True):
-                            # inv_cov_maps_temp is in order 00, 01, 02, ..., 0(N_freqs_to_use[j]-1), 11, 12, ..., 1(N_freqs_to_use[j]-1), 22, 23, ...
-                            inv_cov_maps_temp[count] = inv_covmat[a-a_min][b-a_min] #by construction we're going through cov_maps_temp in the same order as it was populated above
-                            count+=1
+                # check the inversion; by default only in a random subset of pixels, since the full check costs as much as the inversion
+                if info.check_inv_covmat_all_pixels:
+                    check_pix = slice(None)
+                else:
+                    check_pix = np.random.default_rng(j).choice(int(N_pix_to_use[j]), size=min(1024, int(N_pix_to_use[j])), replace=False)
+                assert np.allclose(np.matmul(inv_covmat[check_pix], covmat[check_pix]), _eye(int(N_freqs_to_use[j])), rtol=1.e-2, atol=1.e-2), "covmat inversion failed for scale "+str(j) #, covmat, inv_covmat, np.dot(inv_covmat, covmat)-np.eye(int(N_freqs_to_use[j]))
+                # inv_cov_maps_temp is the upper triangle, in the order of the pairs (ia_inv, ib_inv)
+                inv_cov_maps_temp[:] = np.transpose(inv_covmat[:,ia_inv,ib_inv])
                 weights = compute_weights_at_scale(info,j,inv_cov_maps_temp,A_mix,scale_info_wvs,resp_tol)
                 # save inverse covariance maps for future use
-                count=0
-                for a in range(info.N_freqs):
-                    for b in range(a, info.N_freqs):
-                        if (freqs_to_use[j][a] == True) and (freqs_to_use[j][b] == True):
-                            inv_cov_filename = _inv_cov_filename(info,j,a,b)
-                            hp.write_map(inv_cov_filename, inv_cov_maps_temp[count], nest=False, dtype=np.float64, overwrite=False)
-                            count+=1
+                np.save(inv_cov_store_filename, inv_cov_maps_temp)
+                np.save(inv_cov_freqs_filename, freqs)
                 print('done computing all inverse covariance maps at scale '+str(j))
                 del cov_maps_temp #free up memory
             del inv_cov_maps_temp #free up memory
             print('done computing all ILC weights at scale '+str(j))
+            # the per-pixel cov matrices can be very poorly conditioned (condition numbers of 1e6-1e7 are typical), so the weights are
+            # kept, saved and applied in double precision: rounding them to single precision breaks the response constraints
+            if info.cache_weights:
+                np.save(weights_store_filename, weights)
+                np.savez(weights_mix_filename, freqs=np.flatnonzero(freqs_to_use[j]), A_mix=A_mix)
             ##########################
             # only save these maps of the ILC weights if requested
             if (info.save_weights == 'yes' or info.save_weights == 'Yes' or info.save_weights == 'YES'):
+                _write_maps([_weights_filename(info,a,j) for a in np.flatnonzero(freqs_to_use[j])], np.transpose(weights))
                 count=0
                 for a in range(info.N_freqs):
                     if (freqs_to_use[j][a] == True):
-                        weight_filename = _weights_filename(info,a,j)
-                        hp.write_map(weight_filename, weights[:,count], nest=False, dtype=np.float64, overwrite=False)
                         if map_images == True: #save images if requested
                             plt.clf()
                             hp.mollview(weights[:,count], unit="1/K", title="Needlet ILC Weight Map, Frequency "+str(a)+" Scale "+str(j))
@@ -802,28 +1003,36 @@ def wavelet_ILC(wv=None, info=None,  resp_tol=1.e-3, map_images=False):
                                 plt.savefig(info.output_dir+info.output_prefix+'_needletILCweightmap_freq'+str(a)+'_scale'+str(j)+'_component_'+info.ILC_preserved_comp+'_deproject_'+'_'.join(ILC_deproj_comps)+'_crossILC'*info.cross_ILC+info.output_suffix+'.pdf')
 
                         count+=1
+        elif weights_stored:
+            # the cached weights are only reused if they were computed for the same frequencies and SEDs, and still pass the response check
+            A_mix = _mixing_matrix(info, freqs_to_use[j], ILC_deproj_comps[:N_deproj])
+            with np.load(weights_mix_filename) as weights_mix:
+                assert np.array_equal(weights_mix['freqs'], np.flatnonzero(freqs_to_use[j])), "frequencies used in "+weights_store_filename+" do not match those used at scale "+str(j)
+                assert np.allclose(weights_mix['A_mix'], A_mix, rtol=1.e-10, atol=0.), "mixing matrix used in "+weights_store_filename+" does not match the one at scale "+str(j)+"; use a different output_suffix if the SEDs were modified"
+            weights = np.load(weights_store_filename, mmap_mode='r')
+            assert weights.shape == (int(N_pix_to_use[j]), int(N_freqs_to_use[j])), "weights in "+weights_store_filename+" do not match the pixels and frequencies used at scale "+str(j)
+            _check_response(np.einsum('pi,ia->ap', weights, A_mix), j, resp_tol)
         else:
-            weights = np.zeros((int(N_pix_to_use[j]),int(N_freqs_to_use[j])))
-            count=0
-            for a in range(info.N_freqs):
-                if (freqs_to_use[j][a] == True):
-                    weight_filename = _weights_filename(info,a,j)
-                    weights[:,count] = hp.read_map(weight_filename, dtype=np.float64, )
-                    count+=1
+            weights = np.transpose(_read_maps([_weights_filename(info,a,j) for a in np.flatnonzero(freqs_to_use[j])], np.zeros((int(N_freqs_to_use[j]), int(N_pix_to_use[j])))))
         ##########################
         # apply these ILC weights to the needlet coefficient maps to get the per-needlet-scale ILC maps
+        # the needlet coefficient maps are read as memory-mapped views of their files (or taken from memory), and are streamed through
+        # in blocks of pixels: each block of all the frequencies used at this scale is stacked into a small buffer, so that the weighted
+        # sum over frequencies is a single contraction per block, without copying the full maps into memory
+        if not info.apply_weights_to_other_maps:
+            filenames_wavelet_coeff_map = [info.output_dir+info.output_prefix+'_needletcoeffmap_freq'+str(a)+'_scale'+str(j)+'.fits' for a in np.flatnonzero(freqs_to_use[j])]
+            wavelet_coeff_maps = [_read_wavelet_map(info, filename, keep=False) for filename in filenames_wavelet_coeff_map]
+        else:
+            wavelet_coeff_maps = [maps_for_weights_needlets[a][j] for a in np.flatnonzero(freqs_to_use[j])]
         ILC_map_temp = np.zeros(int(N_pix_to_use[j]))
-        count=0
-        for a in range(info.N_freqs):
-            if (freqs_to_use[j][a] == True):
-                filename_wavelet_coeff_map = info.output_dir+info.output_prefix+'_needletcoeffmap_freq'+str(a)+'_scale'+str(j)+'.fits'
-                if not info.apply_weights_to_other_maps:
-                    wavelet_coeff_map = hp.read_map(filename_wavelet_coeff_map, dtype=np.float64)
-                else:
-                    wavelet_coeff_map =maps_for_weights_needlets[a][j]
-                #wavelet_coeff_map = hp.read_map(filename_wavelet_coeff_map, dtype=np.float64)
-                ILC_map_temp += weights[:,count] * wavelet_coeff_map
-                count+=1
+        block_size = min(2**20, int(N_pix_to_use[j]))
+        block = np.zeros((len(wavelet_coeff_maps), block_size))
+        for start in range(0, int(N_pix_to_use[j]), block_size):
+            stop = min(start+block_size, int(N_pix_to_use[j]))
+            for count, wavelet_coeff_map in enumerate(wavelet_coeff_maps):
+                block[count,:stop-start] = wavelet_coeff_map[start:stop]
+            np.einsum('pi,ip->p', weights[start:stop], block[:,:stop-start], out=ILC_map_temp[start:stop])
+        del wavelet_coeff_maps, block #free up memory
         ILC_maps_per_scale.append(ILC_map_temp)
     ##########################
     # synthesize the per-needlet-scale ILC maps into the final combined ILC map (apply each needlet filter again and add them all together -- have to upgrade to all match the same Nside -- done in synthesize)
@@ -871,31 +1080,10 @@ def harmonic_ILC(wv=None, info=None, resp_tol=1.e-3, map_images=False):
     assert(info.wavelet_beam_criterion > 0. and info.wavelet_beam_criterion < 1.)
     assert info.N_side > 0, "N_side cannot be negative or zero"
     ##########################
-    # criterion to determine which frequency maps to use for each wavelet filter scale
-    # require multipole ell_F where wavelet filter F(ell_F) = info.wavelet_beam_criterion (on its decreasing side)
-    #   to be less than the multipole ell_B where the beam B(ell_B) = info.wavelet_beam_criterion
-    # note that this assumes monotonicity of the beam
-    # and assumes filter function has a decreasing side, which is generally not true for the smallest-scale wavelet filter
-    freqs_to_use = np.full((wv.N_scales,info.N_freqs), False)
-    N_freqs_to_use = np.zeros(wv.N_scales,dtype=int)
-    N_side_to_use = np.ones(wv.N_scales,dtype=int)*info.N_side #initialize all of the internal, per-scale N_side values to the output N_side
-    ell_F = np.zeros(wv.N_scales)
-    ell_B = np.zeros(info.N_freqs)
-    for i in range(wv.N_scales-1):
-        ell_peak = np.argmax(wv.filters[i]) #we'll use this to ensure we're on the decreasing side of the filter
-        ell_F[i] = ell_peak + (np.abs( wv.filters[i][ell_peak:] - info.wavelet_beam_criterion )).argmin()
-        if ell_F[i] > wv.ELLMAX:
-            ell_F[i] = wv.ELLMAX
-    ell_F[-1] = ell_F[-2] #just use the second-to-last criterion for the last one #TODO: improve this
-    for j in range(info.N_freqs):
-        ell_B[j] = (np.abs( (info.beams[j])[:,1] - info.wavelet_beam_criterion )).argmin()
+    # determine which frequency maps to use, and the N_side value to use, for each wavelet filter scale
+    freqs_to_use, N_side_to_use = _freqs_and_N_side_to_use(wv, info)
+    N_freqs_to_use = np.sum(freqs_to_use, axis=1)
     for i in range(wv.N_scales):
-        for j in range(info.N_freqs):
-            if ell_F[i] <= ell_B[j]:
-                freqs_to_use[i][j] = True
-                N_freqs_to_use[i] += 1
-            else:
-                freqs_to_use[i][j] = False
         # check that number of frequencies is non-zero
         assert(N_freqs_to_use[i] > 0), "insufficient number of channels for high-resolution filter(s)"
         # check that we still have enough frequencies for desired deprojection at each filter scale
@@ -903,13 +1091,6 @@ def harmonic_ILC(wv=None, info=None, resp_tol=1.e-3, map_images=False):
             assert((info.N_deproj + 1) <= N_freqs_to_use[i]), "not enough frequency channels to deproject this many components"
         else:
             assert((info.N_deproj[i] + 1) <= N_freqs_to_use[i]), "not enough frequency channels to deproject this many components at scale "+str(i)
-        # determine N_side value to use for each filter scale, by finding the smallest valid N_side larger than ell_F[i]
-        for j in range(20):
-            if (ell_F[i] < 2**j):
-                N_side_to_use[i] = int(2**j)
-                break
-        if (N_side_to_use[i] > info.N_side):
-            N_side_to_use[i] = info.N_side
     N_pix_to_use = 12*(N_side_to_use)**2
     ##########################
     ##########################
@@ -940,6 +1121,7 @@ def harmonic_ILC(wv=None, info=None, resp_tol=1.e-3, map_images=False):
         t1j=time.time()
         # first, check if the weights already exist, and skip everything if so
         weights_exist = True
+        ILC_deproj_comps = []
         if type(info.N_deproj) is int:
             N_deproj = info.N_deproj
             if info.N_deproj>0:
@@ -965,61 +1147,17 @@ def harmonic_ILC(wv=None, info=None, resp_tol=1.e-3, map_images=False):
             # units of A_mix are K_CMB
             # Note: only include channels that are being used for this filter scale
             N_comps = (N_deproj + 1)
-            A_mix = np.zeros((int(N_freqs_to_use[j]),N_comps))
-            countt = 0
-            for a in range(info.N_freqs):
-                if (freqs_to_use[j][a] == True):
-                    for b in range(N_comps):
-                        if (b == 0): # zero^th component is special (this is the one being preserved in the ILC)
-                            if (info.bandpass_type == 'DeltaBandpasses'):
-                                # N.B. get_mix and get_mix_bandpassed assume the input maps are in uK_CMB, i.e., responses are computed in uK_CMB, but we are assuming in this code that all maps are in K_CMB, hence factor of 1.e-6 below
-                                # However, note that as a consequence an output NILC CMB map from this code has units of uK_CMB!
-                                A_mix[countt][b] = 1.e-6 * (get_mix([info.freqs_delta_ghz[a]], info.ILC_preserved_comp, param_dict_file=info.param_dict_file, param_dict_override=None, dust_beta_param_name='beta_CIB', radio_beta_param_name='beta_radio'))[0] #convert to K from uK
-                            elif (info.bandpass_type == 'ActualBandpasses'):
-                                A_mix[countt][b] = 1.e-6 * (get_mix_bandpassed([info.freq_bp_files[a]], info.ILC_preserved_comp, param_dict_file=info.param_dict_file, param_dict_override=None, dust_beta_param_name='beta_CIB', radio_beta_param_name='beta_radio'))[0] #convert to K from uK
-                        else:
-                            if (info.bandpass_type == 'DeltaBandpasses'):
-                                A_mix[countt][b] = 1.e-6 * (get_mix([info.freqs_delta_ghz[a]], ILC_deproj_comps[b-1], param_dict_file=info.param_dict_file, param_dict_override=None, dust_beta_param_name='beta_CIB', radio_beta_param_name='beta_radio'))[0] #convert to K from uK
-                            elif (info.bandpass_type == 'ActualBandpasses'):
-                                A_mix[countt][b] = 1.e-6 * (get_mix_bandpassed([info.freq_bp_files[a]], ILC_deproj_comps[b-1], param_dict_file=info.param_dict_file, param_dict_override=None, dust_beta_param_name='beta_CIB', radio_beta_param_name='beta_radio'))[0] #convert to K from uK
-                    countt += 1
-            # normalize the columns of A_mix corresponding to the deprojected components so that they have values near unity
-            if (N_deproj != 0):
-                for b in range(1,N_deproj+1):
-                    max_temp = np.amax(A_mix[:,b])
-                    A_mix[:,b] = A_mix[:,b]/max_temp
+            A_mix = _mixing_matrix(info, freqs_to_use[j], ILC_deproj_comps[:N_deproj])
             ##############################
             ##############################
             # for each filter scale, compute maps of the smoothed real-space frequency-frequency covariance matrix using the Gaussians determined above
-            cov_maps_temp = []
-            flag=True
-            cont = False
-            for a in range(info.N_freqs):
-                start_at = a
-                if info.cross_ILC:
-                    start_at = 0
-                for b in range(start_at, info.N_freqs):
-                    if (freqs_to_use[j][a] == True) and (freqs_to_use[j][b] == True and flag==True and not cont):
-                        # Note that for HILC the covmat has no pixel index and only needs {freq1, freq2} indices at every scale. So we save it at every scale in a .txt file as a 2-d numpy array
-                        cov_filename = info.output_dir+info.output_prefix+'_needletcoeff_covmap_scale'+str(j)+'_crossILC'*info.cross_ILC+'.txt' 
-                        exists = os.path.isfile(cov_filename)
-                        if exists:
-                            cov_matrix_harmonic = np.loadtxt(cov_filename)
-                            cont = True
-                        else:
-                            flag=False
-                            break
-            if flag == False:
-                cov_matrix_harmonic = np.zeros((int(N_freqs_to_use[j]),int(N_freqs_to_use[j])))
-                counta = 0
-                for a in range(info.N_freqs):
-                    countb = 0
-                    for b in range(0, info.N_freqs): #  Could probably do this quicker by starting at a instead of 0 when not doing cross_ILC but would have to keep track of count_a and count_b
-                        if (freqs_to_use[j][a] == True) and (freqs_to_use[j][b] == True):
-                            cov_matrix_harmonic[counta,countb] = np.sum((2+ells+1)/(4*np.pi)*info.cls[a,b]* (wv.filters[j])**2*taper_func**2)/np.sum(wv.filters[j]**2)
-                            countb +=1
-                    if (freqs_to_use[j][a] == True):
-                        counta +=1
+            # Note that for HILC the covmat has no pixel index and only needs {freq1, freq2} indices at every scale. So we save it at every scale in a .txt file as a 2-d numpy array
+            cov_filename = info.output_dir+info.output_prefix+'_needletcoeff_covmap_scale'+str(j)+'_crossILC'*info.cross_ILC+'.txt'
+            if np.any(freqs_to_use[j]) and os.path.isfile(cov_filename):
+                cov_matrix_harmonic = np.loadtxt(cov_filename)
+            else:
+                freqs = np.flatnonzero(freqs_to_use[j])
+                cov_matrix_harmonic = np.sum((2+ells+1)/(4*np.pi)*info.cls[np.ix_(freqs,freqs)]* (wv.filters[j])**2*taper_func**2, axis=-1)/np.sum(wv.filters[j]**2)
                 cov_filename = info.output_dir+info.output_prefix+'_needletcoeff_covmap_scale'+str(j)+'_crossILC'*info.cross_ILC+'.txt'
                 if info.save_harmonic_covmat:
                     print("saving covmat",cov_filename)
@@ -1032,37 +1170,33 @@ def harmonic_ILC(wv=None, info=None, resp_tol=1.e-3, map_images=False):
                     cov_matrix_harmonic= (cov_matrix_harmonic+ np.transpose(cov_matrix_harmonic))/2.
             inv_covmat_harmonic= np.linalg.inv(cov_matrix_harmonic) # we don't need to bother saving this because it is not expensive to invert this covmat (TODO: check this)
 
-            identity = np.eye(N_freqs_to_use[j])
+            identity = _eye(int(N_freqs_to_use[j]))
             assert np.allclose(np.matmul(inv_covmat_harmonic,cov_matrix_harmonic),identity,rtol=1.e-3, atol=1.e-3)
             inv_covmat_temp = inv_covmat_harmonic[:,:,None]
 
             ### for each filter scale, perform cov matrix inversion and compute maps of the ILC weights using the inverted cov matrix maps
             count=0
             ### construct the matrix Q_{alpha beta} defined in Eq. 30 of McCarthy & Hill 2023 for each pixel at this wavelet scale and evaluate Eq. 29 to get weights ###
-            tmp1 = np.einsum('ai,jip->ajp', np.transpose(A_mix), inv_covmat_temp)
-            Qab_pix = np.einsum('ajp,bj->abp', tmp1, np.transpose(A_mix))
+            # Q = A^T C^-1 A, computed as two BLAS matrix products without the intermediate (N_comps, N_freqs, 1) einsum array
+            A_mix_T = np.ascontiguousarray(A_mix.T)
+            Qab_pix = np.matmul(np.matmul(A_mix_T, inv_covmat_harmonic), A_mix)[:,:,None]
             # compute weights 
             tempvec = np.zeros((N_comps, 1))
             # treat the no-deprojection case separately, since QSa_temp is empty in this case
             if (N_comps == 1):
                 tempvec[0] = [1.0]*int(1)
             else:
-                for a in range(N_comps):
-                    QSa_temp = np.delete(np.delete(Qab_pix, a, 0), 0, 1) #remove the a^th row and zero^th column
-                    tempvec[a] = (-1.0)**float(a) * np.linalg.det(np.transpose(QSa_temp,(2,0,1)))
-            tmp2 = np.einsum('ia,ap->ip', A_mix, tempvec)
-            tmp3 = np.einsum('jip,ip->jp', inv_covmat_temp, tmp2)
+                # gather all the submatrices QSa (Q with the a^th row and zeroth column removed) in one indexing call, instead of two np.delete copies per a
+                rows = np.array([[r for r in range(N_comps) if r != a] for a in range(N_comps)])
+                cols = np.arange(1, N_comps)
+                QSa_temp = Qab_pix[rows[:,:,None], cols[None,None,:], 0] #dimensions N_comps x (N_comps-1) x (N_comps-1)
+                tempvec[:,0] = (-1.0)**np.arange(N_comps) * np.linalg.det(QSa_temp)
+            # C^-1 A tempvec in one call, with the small product A tempvec done first
+            tmp3 = np.einsum('jip,ip->jp', inv_covmat_temp, np.matmul(A_mix, tempvec), optimize=True)
             weights = 1.0/np.linalg.det(np.transpose(Qab_pix,(2,0,1)))[:,None] * np.transpose(tmp3) #N.B. 'weights' here only includes channels that passed beam_thresh criterion
             # response verification
-            response = np.einsum('pi,ia->ap', weights, A_mix) #dimensions N_comps x N_pix_to_use[j]
-            optimal_response_preserved_comp = np.ones(1)
-            optimal_response_deproj_comp = np.zeros((N_comps-1, 1))
-            if not (np.absolute(response[0]-optimal_response_preserved_comp) < resp_tol).all():
-                print('preserved component response failed at wavelet scale '+str(j)+'; these should be zero: '+str(np.absolute(response[0]-optimal_response_preserved_comp))+' (tol is '+str(resp_tol)+')')
-                quit()
-            if not (np.absolute(response[1:]-optimal_response_deproj_comp) < resp_tol).all():
-                print('deprojected component response failed at wavelet scale '+str(j)+'; these should be zero:'+str(np.absolute(response[1:]-optimal_response_deproj_comp))+' (tol is '+str(resp_tol)+')')
-                quit()
+            response = np.einsum('pi,ia->ap', weights, A_mix) #dimensions N_comps x 1
+            _check_response(response, j, resp_tol)
 
 
             ##########################
@@ -1098,7 +1232,7 @@ def harmonic_ILC(wv=None, info=None, resp_tol=1.e-3, map_images=False):
     for a in range(info.N_freqs):
         wavelet_coeff_alm = info.alms[a]
         ILC_alm += hp.almxfl(wavelet_coeff_alm ,ILC_filters[a])
-    ILC_map = hp.alm2map(ILC_alm,nside=info.N_side)
+    ILC_map = _alm2map(ILC_alm, info.N_side)
     #ILC_map = synthesize(wv_maps=ILC_maps_per_scale, wv=wv, N_side_out=info.N_side)
     # save the final ILC map
     ILC_map_filename = info.output_dir+info.output_prefix+'needletILCmap'+'_component_'+info.ILC_preserved_comp+'_crossILC'*info.cross_ILC+info.output_suffix+'.fits'